@@ -0,0 +1,62 @@
+"""
+Запись архива устаревших сообщений в сжатые файлы JSONL или CSV.
+Каждый пакет строк сжимается в отдельный gzip-член и дописывается в файл
+с fsync, поэтому после записи пакет можно удалять из БД. Файлы ротируются по размеру.
+"""
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = ['id', 'user_id', 'user_full_name', 'message_date', 'message_id', 'last_reply_time']
+
+
+class ArchiveWriter:
+    """Дописывает пакеты строк в ротируемые файлы архива"""
+
+    def __init__(self, directory, archive_format, max_file_bytes):
+        if archive_format not in ('jsonl', 'csv'):
+            raise ValueError(f"Неизвестный формат архива: {archive_format}")
+        self.directory = directory
+        self.archive_format = archive_format
+        self.max_file_bytes = max_file_bytes
+        self._path = None
+        self._file_number = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_new_file(self):
+        self._file_number += 1
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self._path = os.path.join(self.directory,
+                                  f"messages-{timestamp}-{self._file_number}.{self.archive_format}.gz")
+        logger.info(f"Новый файл архива: {self._path}")
+
+    def _serialize(self, rows, with_header):
+        buffer = io.StringIO()
+        if self.archive_format == 'jsonl':
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(ARCHIVE_COLUMNS, row)), ensure_ascii=False))
+                buffer.write('\n')
+        else:
+            writer = csv.writer(buffer)
+            if with_header:
+                writer.writerow(ARCHIVE_COLUMNS)
+            writer.writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+
+    def write_chunk(self, rows):
+        """Надежно записывает пакет строк на диск; после возврата строки можно удалять"""
+        if self._path is None or os.path.getsize(self._path) >= self.max_file_bytes:
+            self._open_new_file()
+        with_header = not os.path.exists(self._path)
+        data = gzip.compress(self._serialize(rows, with_header))
+        with open(self._path, 'ab') as archive_file:
+            archive_file.write(data)
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        return len(data)
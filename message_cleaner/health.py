@@ -0,0 +1,110 @@
+"""
+Проверки здоровья сервиса очистки для docker и оркестраторов.
+HTTP-сервер работает в фоновом потоке: /healthz (живость) сообщает, не завис ли текущий
+запуск очистки, /readyz (готовность) проверяет БД запросом SELECT 1 и сообщает
+время и результат последнего запуска.
+"""
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+def _age(timestamp, now):
+    return round(now - timestamp, 1) if timestamp is not None else None
+
+
+class CleanerHealth:
+    """Состояние сервиса очистки для проверок здоровья"""
+
+    def __init__(self, ping, max_run_seconds):
+        self.ping = ping
+        self.max_run_seconds = max_run_seconds
+        self.ready = False
+        self.run_started = None
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self._run_errors = []
+        self._lock = threading.Lock()
+
+    def start_run(self):
+        with self._lock:
+            self.run_started = time.time()
+            self._run_errors = []
+
+    def record_error(self, error):
+        """Запоминает ошибку текущего запуска (функции очистки не пробрасывают исключения)"""
+        with self._lock:
+            self._run_errors.append(str(error))
+
+    def finish_run(self):
+        with self._lock:
+            now = time.time()
+            if self.run_started is not None:
+                self.last_duration = round(now - self.run_started, 1)
+            self.run_started = None
+            self.last_run = now
+            self.last_error = '; '.join(self._run_errors) or None
+
+    def _run_state(self, now):
+        with self._lock:
+            return {
+                'running_for': _age(self.run_started, now),
+                'last_run_age': _age(self.last_run, now),
+                'last_duration': self.last_duration,
+                'last_error': self.last_error,
+            }
+
+    def liveness(self):
+        """Жив, пока текущий запуск очистки не идет дольше max_run_seconds"""
+        payload = self._run_state(time.time())
+        running_for = payload['running_for']
+        return running_for is None or running_for <= self.max_run_seconds, payload
+
+    def readiness(self):
+        alive, payload = self.liveness()
+        db_ok = False
+        try:
+            db_ok = self.ping()
+        except Exception as e:
+            payload['db_error'] = str(e)
+        payload.update(ready=self.ready, db='ok' if db_ok else 'fail')
+        return alive and self.ready and db_ok, payload
+
+
+def _make_handler(health):
+    routes = {'/healthz': health.liveness, '/readyz': health.readiness}
+
+    class HealthRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            check = routes.get(self.path.split('?')[0])
+            if check is None:
+                self.send_error(404)
+                return
+            healthy, payload = check()
+            payload['status'] = 'ok' if healthy else 'fail'
+            body = (json.dumps(payload) + '\n').encode('utf-8')
+            self.send_response(200 if healthy else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Пробы приходят каждые несколько секунд и не должны засорять лог
+            pass
+
+    return HealthRequestHandler
+
+
+def start_health_server(health, host, port):
+    """Запускает HTTP-сервер проверок здоровья в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), _make_handler(health))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    logger.info(f"Проверки здоровья на {host}:{port}: /healthz, /readyz")
+    return server
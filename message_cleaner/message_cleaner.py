@@ -1,9 +1,19 @@
 import time
 import datetime
 import logging
+import os
 import sys
+import sqlite3
+import pymysql
 from peewee import *
-from settings import DB_USER, DB_HOST, DB_NAME, DB_PASSWORD, MESSAGES_TO_DELETE_HOURS
+from archive import ArchiveWriter, ARCHIVE_COLUMNS
+from health import CleanerHealth, start_health_server
+from partitions import get_partition_start, get_partitions_ahead
+from settings import (DB_USER, DB_HOST, DB_NAME, DB_PASSWORD, DB_BACKEND, DB_SQLITE_PATH,
+                      MESSAGES_TO_DELETE_HOURS, CLEANER_BATCH_SIZE, CLEANER_BATCH_PAUSE_MS, MESSAGES_PARTITIONING,
+                      MESSAGES_PARTITIONS_AHEAD, CLEANER_MODE,
+                      ARCHIVE_DIR, ARCHIVE_FORMAT, ARCHIVE_MAX_FILE_MB, HEALTH_PORT, HEALTH_LISTEN,
+                      HEALTH_MAX_RUN_SECONDS)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -12,13 +22,21 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-dbhandle = MySQLDatabase(
-    DB_NAME, 
-    user=DB_USER,
-    password=DB_PASSWORD,
-    host=DB_HOST,
-    charset='utf8mb4'
-)
+
+def create_database():
+    """Подключение к хранилищу, выбранному настройкой DB_BACKEND (mysql или sqlite)"""
+    if DB_BACKEND == 'sqlite':
+        return SqliteDatabase(DB_SQLITE_PATH, pragmas={'journal_mode': 'wal', 'busy_timeout': 5000})
+    return MySQLDatabase(
+        DB_NAME, 
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        charset='utf8mb4'
+    )
+
+
+dbhandle = create_database()
 
 
 class Messages(Model):
@@ -34,6 +52,28 @@ class Messages(Model):
     last_reply_time = BigIntegerField(null=True)
 
 
+class ForwardedMessages(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'forwardedmessages'
+
+    admin_message_id = BigIntegerField(primary_key=True)
+    user_id = BigIntegerField()
+    message_id = BigIntegerField()
+    message_date = BigIntegerField()
+    user_full_name = CharField()
+    nickname = CharField(null=True)
+
+
+class AdminReplies(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'adminreplies'
+
+    admin_message_id = BigIntegerField(primary_key=True)
+    message_date = BigIntegerField()
+
+
 def wait_for_tables(max_retries=30, delay=10):
     """Ждет, пока основной бот создаст таблицы"""
     for attempt in range(max_retries):
@@ -43,10 +83,7 @@ def wait_for_tables(max_retries=30, delay=10):
             dbhandle.connect(reuse_if_open=True)
             
             # Проверяем, существует ли таблица messages
-            cursor = dbhandle.execute_sql("SHOW TABLES LIKE 'messages'")
-            result = cursor.fetchone()
-            
-            if result:
+            if dbhandle.table_exists('messages'):
                 # Дополнительно проверим, что можем выполнить простой запрос
                 Messages.select().count()
                 logger.info("✅ Таблица messages найдена и доступна")
@@ -70,33 +107,231 @@ def wait_for_tables(max_retries=30, delay=10):
     return False
 
 
+def ping_database():
+    """Проверка доступности БД для /readyz; выполняется в потоке HTTP-сервера со своим соединением"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        dbhandle.execute_sql('SELECT 1').fetchone()
+        return True
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+cleaner_health = CleanerHealth(ping_database, HEALTH_MAX_RUN_SECONDS)
+
+
+def delete_in_batches(model, condition, order_by):
+    """Удаляет строки пакетами по CLEANER_BATCH_SIZE; возвращает (удалено строк, пакетов)"""
+    primary_key = model._meta.primary_key
+    deleted_count = 0
+    batches = 0
+    while True:
+        # Выбираем пакет по индексу поля order_by и удаляем его по первичному ключу,
+        # чтобы каждая транзакция держала блокировки недолго
+        keys = [key for key, in model.select(primary_key).where(condition)
+                .order_by(order_by).limit(CLEANER_BATCH_SIZE).tuples()]
+        if not keys:
+            break
+        
+        deleted_count += model.delete().where(primary_key.in_(keys)).execute()
+        batches += 1
+        
+        if len(keys) < CLEANER_BATCH_SIZE:
+            break
+        time.sleep(CLEANER_BATCH_PAUSE_MS / 1000)
+    return deleted_count, batches
+
+
 def remove_obsolete_messages():
-    """Удаляет устаревшие сообщения"""
+    """Удаляет устаревшие сообщения пакетами по CLEANER_BATCH_SIZE строк"""
     try:
         edge = datetime.datetime.now().timestamp() - MESSAGES_TO_DELETE_HOURS * 3600
+        started = time.monotonic()
         
         dbhandle.connect(reuse_if_open=True)
         
-        # Подсчитываем количество записей для удаления
-        messages_to_delete = Messages.select().where(
-            (Messages.last_reply_time.is_null(False)) & 
-            (Messages.last_reply_time < edge)
-        ).count()
-        
-        if messages_to_delete > 0:
-            # Удаляем устаревшие сообщения
-            query = Messages.delete().where(
-                (Messages.last_reply_time.is_null(False)) & 
-                (Messages.last_reply_time < edge)
-            )
-            deleted_count = query.execute()
+        deleted_count, batches = delete_in_batches(
+            Messages,
+            (Messages.last_reply_time.is_null(False)) & (Messages.last_reply_time < edge),
+            Messages.last_reply_time
+        )
+        
+        elapsed = time.monotonic() - started
+        rate = deleted_count / elapsed if elapsed > 0 else 0
+        logger.info(f"Удалено {deleted_count} устаревших сообщений (старше {MESSAGES_TO_DELETE_HOURS} часов) "
+                    f"пакетами: {batches}, за {elapsed:.2f} сек ({rate:.0f} строк/сек)")
+            
+    except Exception as e:
+        logger.error(f"Ошибка при удалении устаревших сообщений: {e}")
+        cleaner_health.record_error(e)
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def open_streaming_connection():
+    """Открывает отдельное соединение с курсором на стороне сервера для потокового чтения"""
+    if DB_BACKEND == 'sqlite':
+        # Курсор SQLite и так читает строки по мере выборки, WAL не блокирует удаление пакетов
+        return sqlite3.connect(DB_SQLITE_PATH)
+    return pymysql.connect(
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        charset='utf8mb4',
+        cursorclass=pymysql.cursors.SSCursor
+    )
+
+
+def archive_messages(query, params=(), delete_archived=True):
+    """Потоково выгружает строки запроса в архив пакетами по CLEANER_BATCH_SIZE.
+    Каждый пакет удаляется из БД только после надежной записи на диск"""
+    writer = ArchiveWriter(ARCHIVE_DIR, ARCHIVE_FORMAT, ARCHIVE_MAX_FILE_MB * 1024 * 1024)
+    started = time.monotonic()
+    archived_count = 0
+    
+    stream_connection = open_streaming_connection()
+    try:
+        cursor = stream_connection.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(CLEANER_BATCH_SIZE)
+            if not rows:
+                break
             
-            logger.info(f"Удалено {deleted_count} устаревших сообщений (старше {MESSAGES_TO_DELETE_HOURS} часов)")
+            writer.write_chunk(rows)
+            archived_count += len(rows)
+            
+            if delete_archived:
+                dbhandle.connect(reuse_if_open=True)
+                Messages.delete().where(Messages.id.in_([row[0] for row in rows])).execute()
+                time.sleep(CLEANER_BATCH_PAUSE_MS / 1000)
+    finally:
+        stream_connection.close()
+    
+    elapsed = time.monotonic() - started
+    rate = archived_count / elapsed if elapsed > 0 else 0
+    logger.info(f"Заархивировано {archived_count} сообщений за {elapsed:.2f} сек ({rate:.0f} строк/сек)")
+    return archived_count
+
+
+def archive_obsolete_messages():
+    """Переносит устаревшие сообщения в архив на диске"""
+    try:
+        edge = datetime.datetime.now().timestamp() - MESSAGES_TO_DELETE_HOURS * 3600
+        archive_messages(
+            f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM messages "
+            f"WHERE last_reply_time IS NOT NULL AND last_reply_time < {dbhandle.param} ORDER BY id",
+            (edge,)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при архивации устаревших сообщений: {e}")
+        cleaner_health.record_error(e)
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_messages_partitions():
+    """Возвращает список (имя секции, верхняя граница) таблицы messages"""
+    cursor = dbhandle.execute_sql(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    )
+    return [(name, None if description == 'MAXVALUE' else int(description)) for name, description in cursor.fetchall()]
+
+
+def maintain_partitions():
+    """Создает секции таблицы messages наперед и удаляет секции старше срока хранения"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        
+        partitions = get_messages_partitions()
+        if not partitions:
+            logger.warning("Таблица messages не секционирована, обслуживание секций пропущено")
+            return
+        
+        now = datetime.datetime.now().timestamp()
+        
+        # Создаем недостающие секции, отделяя их от последней секции MAXVALUE.
+        # Первые секции бот создает вместе с таблицей
+        bounds = [bound for _, bound in partitions if bound is not None]
+        last_bound = max(bounds) if bounds else get_partition_start(now, MESSAGES_PARTITIONING)
+        new_partitions = get_partitions_ahead(last_bound, now, MESSAGES_PARTITIONING, MESSAGES_PARTITIONS_AHEAD)
+        if new_partitions:
+            dbhandle.execute_sql(
+                f"ALTER TABLE messages REORGANIZE PARTITION p_future INTO "
+                f"({', '.join(new_partitions)}, PARTITION p_future VALUES LESS THAN MAXVALUE)"
+            )
+            logger.info(f"Создано секций таблицы messages: {len(new_partitions)}")
+        
+        # Удаление секции — операция над метаданными, без построчного удаления
+        edge = now - MESSAGES_TO_DELETE_HOURS * 3600
+        expired = [name for name, bound in partitions if bound is not None and bound <= edge]
+        if expired:
+            if CLEANER_MODE == 'archive':
+                # Сначала сохраняем содержимое секций, удаление секции отменить нельзя
+                for name in expired:
+                    archive_messages(f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM messages PARTITION ({name}) "
+                                     "ORDER BY id", delete_archived=False)
+            started = time.monotonic()
+            dbhandle.execute_sql(f"ALTER TABLE messages DROP PARTITION {', '.join(expired)}")
+            logger.info(f"Удалены секции {expired} за {time.monotonic() - started:.2f} сек")
         else:
-            logger.info("Нет устаревших сообщений для удаления")
+            logger.info("Нет секций старше срока хранения")
             
     except Exception as e:
-        logger.error(f"Ошибка при удалении устаревших сообщений: {e}")
+        logger.error(f"Ошибка при обслуживании секций таблицы messages: {e}")
+        cleaner_health.record_error(e)
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def remove_obsolete_forwarded_messages():
+    """Удаляет устаревшие соответствия пересланных сообщений"""
+    try:
+        edge = datetime.datetime.now().timestamp() - MESSAGES_TO_DELETE_HOURS * 3600
+        
+        dbhandle.connect(reuse_if_open=True)
+        
+        # Таблица появляется после миграции схемы в основном боте
+        if not ForwardedMessages.table_exists():
+            return
+        
+        deleted_count, batches = delete_in_batches(ForwardedMessages, ForwardedMessages.message_date < edge,
+                                                   ForwardedMessages.message_date)
+        logger.info(f"Удалено {deleted_count} устаревших соответствий пересланных сообщений пакетами: {batches}")
+            
+    except Exception as e:
+        logger.error(f"Ошибка при удалении устаревших соответствий пересланных сообщений: {e}")
+        cleaner_health.record_error(e)
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def remove_obsolete_admin_replies():
+    """Удаляет устаревшие отметки обработанных сообщений админов"""
+    try:
+        edge = datetime.datetime.now().timestamp() - MESSAGES_TO_DELETE_HOURS * 3600
+        
+        dbhandle.connect(reuse_if_open=True)
+        
+        # Таблица появляется после миграции схемы в основном боте
+        if not AdminReplies.table_exists():
+            return
+        
+        deleted_count, batches = delete_in_batches(AdminReplies, AdminReplies.message_date < edge,
+                                                   AdminReplies.message_date)
+        logger.info(f"Удалено {deleted_count} устаревших отметок ответов админов пакетами: {batches}")
+            
+    except Exception as e:
+        logger.error(f"Ошибка при удалении устаревших отметок ответов админов: {e}")
+        cleaner_health.record_error(e)
     finally:
         if not dbhandle.is_closed():
             dbhandle.close()
@@ -106,17 +341,45 @@ def main():
     """Основная функция"""
     logger.info("Запуск сервиса очистки сообщений...")
     
+    if DB_BACKEND not in ('mysql', 'sqlite'):
+        # База в памяти принадлежит процессу бота, очистку выполняет сам бот (RETENTION_IN_BOT)
+        logger.critical(f"Хранилище {DB_BACKEND} не поддерживается сервисом очистки. Завершение работы.")
+        sys.exit(1)
+    
+    if HEALTH_PORT > 0:
+        start_health_server(cleaner_health, HEALTH_LISTEN, HEALTH_PORT)
+    
+    if CLEANER_MODE == 'archive' and not os.path.isabs(ARCHIVE_DIR):
+        # Удаленные из БД строки остаются только в архиве: он должен лежать в постоянном томе
+        logger.warning(f"Каталог архива ARCHIVE_DIR={ARCHIVE_DIR} задан относительным путем; "
+                       f"в контейнере укажите каталог в подключенном томе, иначе архив пропадет "
+                       f"при пересоздании контейнера")
+    
+    partitioned = MESSAGES_PARTITIONING != 'none' and DB_BACKEND == 'mysql'
+    if MESSAGES_PARTITIONING != 'none' and not partitioned:
+        logger.warning("Секционирование messages поддерживается только в MySQL, используется построчная очистка")
+    
     # Ждем, пока основной бот создаст таблицы
     if not wait_for_tables():
         logger.critical("Не удалось дождаться создания таблиц. Завершение работы.")
         sys.exit(1)
+    cleaner_health.ready = True
     
     logger.info(f"Сервис очистки запущен. Проверка каждые 24 часа, удаление сообщений старше {MESSAGES_TO_DELETE_HOURS} часов.")
     
     # Основной цикл
     while True:
         try:
-            remove_obsolete_messages()
+            cleaner_health.start_run()
+            if partitioned:
+                maintain_partitions()
+            elif CLEANER_MODE == 'archive':
+                archive_obsolete_messages()
+            else:
+                remove_obsolete_messages()
+            remove_obsolete_forwarded_messages()
+            remove_obsolete_admin_replies()
+            cleaner_health.finish_run()
             logger.info("Следующая проверка через 24 часа")
             time.sleep(86400)  # 24 часа
         except KeyboardInterrupt:
@@ -124,6 +387,8 @@ def main():
             break
         except Exception as e:
             logger.error(f"Неожиданная ошибка в основном цикле: {e}")
+            cleaner_health.record_error(e)
+            cleaner_health.finish_run()
             logger.info("Ожидание 10 минут перед повторной попыткой...")
             time.sleep(600)  # 10 минут
 
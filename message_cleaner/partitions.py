@@ -0,0 +1,35 @@
+"""
+Границы секций таблицы messages при секционировании по message_date.
+Бот создает по ним первые секции вместе с таблицей, очиститель — следующие.
+Файл одинаков в support_bot и message_cleaner: сервисы собираются из отдельных
+контекстов docker и не могут импортировать код друг друга. Меняйте обе копии вместе.
+"""
+import datetime
+
+# Длительность секции таблицы messages при секционировании по времени
+PARTITION_PERIODS = {
+    'day': 86400,
+    'week': 7 * 86400,
+}
+
+
+def get_partition_start(timestamp, partitioning):
+    """Начало секции (полночь UTC или понедельник), в которую попадает timestamp"""
+    day_start = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    if partitioning == 'week':
+        day_start -= datetime.timedelta(days=day_start.weekday())
+    return int(day_start.timestamp())
+
+
+def get_partition_definition(partition_start, partitioning):
+    """Описание секции, содержащей сообщения с partition_start до начала следующей секции"""
+    name = datetime.datetime.fromtimestamp(partition_start, datetime.timezone.utc).strftime('p%Y%m%d')
+    return f"PARTITION {name} VALUES LESS THAN ({partition_start + PARTITION_PERIODS[partitioning]})"
+
+
+def get_partitions_ahead(first_start, now, partitioning, ahead):
+    """Описания секций с first_start до секции, идущей через ahead периодов после текущей"""
+    period = PARTITION_PERIODS[partitioning]
+    target_bound = get_partition_start(now, partitioning) + (ahead + 1) * period
+    return [get_partition_definition(start, partitioning) for start in range(first_start, target_bound, period)]
@@ -4,4 +4,17 @@ MESSAGES_TO_DELETE_HOURS = int(environ.get('MESSAGES_TO_DELETE_HOURS', 72))
 DB_USER = environ.get('DB_USER')
 DB_PASSWORD = environ.get('DB_PASSWORD')
 DB_NAME = environ.get('DB_NAME')
-DB_HOST = environ.get('DB_HOST')
\ No newline at end of file
+DB_HOST = environ.get('DB_HOST')
+DB_BACKEND = environ.get('DB_BACKEND', 'mysql')
+DB_SQLITE_PATH = environ.get('DB_SQLITE_PATH', 'support_bot.db')
+CLEANER_BATCH_SIZE = int(environ.get('CLEANER_BATCH_SIZE', 1000))
+CLEANER_BATCH_PAUSE_MS = int(environ.get('CLEANER_BATCH_PAUSE_MS', 100))
+MESSAGES_PARTITIONING = environ.get('MESSAGES_PARTITIONING', 'none')
+MESSAGES_PARTITIONS_AHEAD = int(environ.get('MESSAGES_PARTITIONS_AHEAD', 7))
+CLEANER_MODE = environ.get('CLEANER_MODE', 'delete')
+ARCHIVE_DIR = environ.get('ARCHIVE_DIR', 'archive')
+ARCHIVE_FORMAT = environ.get('ARCHIVE_FORMAT', 'jsonl')
+ARCHIVE_MAX_FILE_MB = int(environ.get('ARCHIVE_MAX_FILE_MB', 100))
+HEALTH_PORT = int(environ.get('HEALTH_PORT', 8080))
+HEALTH_LISTEN = environ.get('HEALTH_LISTEN', '0.0.0.0')
+HEALTH_MAX_RUN_SECONDS = int(environ.get('HEALTH_MAX_RUN_SECONDS', 21600))
@@ -0,0 +1,108 @@
+"""
+Кэш заблокированных пользователей в памяти процесса.
+Загружается из БД при старте и обновляется при каждом бане и разбане,
+поэтому проверка входящего сообщения не обращается к БД.
+При нескольких репликах баны и разбаны рассылаются событиями через общее хранилище.
+"""
+import logging
+import threading
+
+from db_async import get_banned_users, set_new_banned_user, remove_banned_user
+from shared_state import shared_store
+
+logger = logging.getLogger(__name__)
+
+
+class BanCache:
+    """Множество ID заблокированных пользователей"""
+
+    def __init__(self):
+        self._user_ids = set()
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def replace(self, user_ids):
+        with self._lock:
+            self._user_ids = set(user_ids)
+            self.loaded = True
+
+    def add(self, user_id):
+        with self._lock:
+            self._user_ids.add(user_id)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._user_ids.discard(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._user_ids
+
+    def __len__(self):
+        return len(self._user_ids)
+
+
+banned_users = BanCache()
+
+# Последнее примененное событие банов из общего хранилища
+_ban_events_cursor = 0
+
+
+async def load_banned_users():
+    """Загружает список заблокированных пользователей из БД в кэш"""
+    banned_users.replace(await get_banned_users())
+    logger.info(f"В кэш загружено заблокированных пользователей: {len(banned_users)}")
+
+
+async def is_user_banned(user_id):
+    """Проверяет, заблокирован ли пользователь"""
+    if not banned_users.loaded:
+        await load_banned_users()
+    return user_id in banned_users
+
+
+async def ban_user(user_id, nickname, full_name):
+    """Блокирует пользователя в БД и в кэше"""
+    await set_new_banned_user(user_id, nickname, full_name)
+    banned_users.add(user_id)
+    if shared_store is not None:
+        await shared_store.publish_ban(user_id, True)
+
+
+async def unban_user(user_id):
+    """Снимает блокировку пользователя в БД и в кэше"""
+    await remove_banned_user(user_id)
+    banned_users.discard(user_id)
+    if shared_store is not None:
+        await shared_store.publish_ban(user_id, False)
+
+
+async def refresh_ban_cache(context):
+    """Периодически перечитывает кэш из БД (для нескольких процессов бота)"""
+    try:
+        await load_banned_users()
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении кэша заблокированных пользователей: {e}")
+
+
+async def start_ban_events_sync():
+    """Запоминает текущее событие банов и загружает кэш, чтобы не пропустить события между ними"""
+    global _ban_events_cursor
+    _ban_events_cursor = await shared_store.get_last_ban_event_id()
+    await load_banned_users()
+
+
+async def sync_ban_events(context):
+    """Применяет к кэшу баны и разбаны, сделанные другими репликами"""
+    global _ban_events_cursor
+    try:
+        events = await shared_store.fetch_ban_events(_ban_events_cursor)
+        for event_id, user_id, banned in events:
+            if banned:
+                banned_users.add(user_id)
+            else:
+                banned_users.discard(user_id)
+            _ban_events_cursor = event_id
+        if events:
+            logger.info(f"Применено событий банов от других реплик: {len(events)}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении событий банов: {e}")
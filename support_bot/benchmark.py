@@ -0,0 +1,226 @@
+"""
+Нагрузочный прогон обработчиков бота.
+Синтетические обновления (текст, медиа, ответы админов на скрытых пользователей,
+обычные ответы и баны) проходят через настоящий forward_message_to_admin_group
+и планировщик обновлений, а запросы к Telegram принимает записывающий фейковый бот.
+По умолчанию используется временная база SQLite, с --db memory — база в памяти,
+с --db mysql — база из настроек DB_* (используйте отдельную тестовую базу, например в контейнере MySQL).
+
+Пример: python benchmark.py --updates 2000 --api-latency-ms 20
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+os.environ.setdefault('ADMIN_CHAT_ID', '-1000000000001')
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+
+import telegram  # noqa: E402
+
+SCENARIOS = ('text', 'media', 'hidden_reply', 'reply', 'ban')
+
+
+class FakeBot:
+    """Бот, который вместо запросов к Telegram записывает вызовы и отвечает заглушками"""
+
+    defaults = None
+
+    def __init__(self, api_latency=0.0):
+        self.api_latency = api_latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(10 ** 9)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            self.calls[name] += 1
+            if self.api_latency:
+                await asyncio.sleep(self.api_latency)
+            if name == 'forward_messages':
+                return tuple(telegram.MessageId(next(self._message_ids)) for _ in kwargs['message_ids'])
+            return telegram.MessageId(next(self._message_ids))
+        return method
+
+
+class Context:
+    """Минимальная замена CallbackContext для обработчиков"""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class UpdateFactory:
+    """Генерирует синтетические обновления для сценариев"""
+
+    def __init__(self, bot, admin_chat_id, ban_message):
+        self.bot = bot
+        self.admin_chat_id = admin_chat_id
+        self.ban_message = ban_message
+        self.now = int(time.time())
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, chat_id, from_user, extra):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': self.now,
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': from_user,
+        }
+        message.update(extra)
+        return telegram.Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def user_message(self, user_id, extra):
+        from_user = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'last_name': str(user_id)}
+        return self._update(user_id, from_user, extra)
+
+    def admin_reply(self, reply_to_message, text):
+        from_user = {'id': 1, 'is_bot': False, 'first_name': 'Admin'}
+        reply_to_message = dict(reply_to_message, date=self.now,
+                                chat={'id': self.admin_chat_id, 'type': 'supergroup'})
+        return self._update(self.admin_chat_id, from_user, {'text': text, 'reply_to_message': reply_to_message})
+
+    def text(self, user_id):
+        return self.user_message(user_id, {'text': f'Вопрос пользователя {user_id}'})
+
+    def media(self, user_id):
+        photo = [{'file_id': f'photo{user_id}', 'file_unique_id': f'u{user_id}', 'width': 640, 'height': 480}]
+        return self.user_message(user_id, {'photo': photo, 'caption': 'Скриншот ошибки'})
+
+    def hidden_reply(self, user_full_name):
+        # Ответ на сообщение, которого нет в таблице соответствий: получатель ищется по имени и дате
+        forward_origin = {'type': 'hidden_user', 'sender_user_name': user_full_name, 'date': self.now}
+        return self.admin_reply({'message_id': next(self._message_ids), 'forward_origin': forward_origin},
+                                'Ответ скрытому пользователю')
+
+    def reply(self, admin_message_id):
+        return self.admin_reply({'message_id': admin_message_id, 'text': 'Вопрос'}, 'Ответ пользователю')
+
+    def ban(self, admin_message_id):
+        return self.admin_reply({'message_id': admin_message_id, 'text': 'Вопрос'}, self.ban_message)
+
+
+async def prepare(args, factory, db_connector, forward_map):
+    """Создает данные, на которые отвечают админы, и возвращает обновления для прогона"""
+    updates = []
+    user_ids = itertools.count(10 ** 6)
+    admin_message_ids = itertools.count(2 * 10 ** 9)
+    scenarios = args.scenarios
+    for i in range(args.updates):
+        scenario = scenarios[i % len(scenarios)]
+        if scenario in ('text', 'media'):
+            updates.append((scenario, getattr(factory, scenario)(next(user_ids))))
+        elif scenario == 'hidden_reply':
+            user_id = next(user_ids)
+            user_full_name = f'Hidden {user_id}'
+            db_connector.Messages.create(user_id=user_id, user_full_name=user_full_name,
+                                         message_date=factory.now, message_id=1)
+            updates.append((scenario, factory.hidden_reply(user_full_name)))
+        else:
+            user_id = next(user_ids)
+            admin_message_id = next(admin_message_ids)
+            db_connector.Messages.create(user_id=user_id, user_full_name=f'User {user_id}',
+                                         message_date=factory.now, message_id=1)
+            await forward_map.remember_forward(admin_message_id, forward_map.ForwardTarget(
+                user_id=user_id, message_id=1, message_date=factory.now,
+                user_full_name=f'User {user_id}', nickname=None))
+            updates.append((scenario, getattr(factory, scenario)(admin_message_id)))
+    return updates
+
+
+async def run_benchmark(args):
+    # Хранилище выбирается до импорта модулей бота, которые читают настройки при импорте
+    temp_dir = tempfile.TemporaryDirectory()
+    os.environ['DB_BACKEND'] = args.db
+    if args.db == 'sqlite':
+        os.environ['DB_SQLITE_PATH'] = os.path.join(temp_dir.name, 'benchmark.db')
+
+    import db_connector
+    import forward_map
+    import run
+    from db_init import create_tables_with_indexes
+    from settings import ADMIN_CHAT_ID, BAN_MESSAGE, UPDATE_CONCURRENCY, UPDATE_MAX_PENDING
+    from update_processor import ChatOrderedUpdateProcessor
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    if not create_tables_with_indexes():
+        raise RuntimeError("Не удалось создать таблицы для нагрузочного прогона")
+
+    bot = FakeBot(args.api_latency_ms / 1000)
+    context = Context(bot)
+    factory = UpdateFactory(bot, ADMIN_CHAT_ID, BAN_MESSAGE)
+    updates = await prepare(args, factory, db_connector, forward_map)
+    # Прогрев кэша банов, чтобы первая пачка обновлений не ждала загрузки
+    await run.load_banned_users()
+    db_connector.start_message_buffer()
+
+    processor = ChatOrderedUpdateProcessor(args.concurrency or UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+    await processor.initialize()
+    latencies = {scenario: [] for scenario in args.scenarios}
+
+    async def process(scenario, update):
+        started = time.perf_counter()
+        await run.forward_message_to_admin_group(update, context)
+        latencies[scenario].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(update, process(scenario, update))
+                           for scenario, update in updates))
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+    db_connector.close_message_buffer()
+
+    print(f"Обновлений: {len(updates)}, время: {elapsed:.2f} сек, "
+          f"пропускная способность: {len(updates) / elapsed:.1f} обн/сек")
+    print(f"{'сценарий':<14}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for scenario, values in latencies.items():
+        values.sort()
+        print(f"{scenario:<14}{len(values):>8}{percentile(values, 50) * 1000:>10.2f}"
+              f"{percentile(values, 95) * 1000:>10.2f}{percentile(values, 99) * 1000:>10.2f}")
+    print(f"Вызовы Bot API: {dict(bot.calls)}")
+    return len(updates) / elapsed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота поддержки")
+    parser.add_argument('--updates', type=int, default=1000, help="количество обновлений")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"сценарии через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help="одновременно обрабатываемых обновлений (по умолчанию UPDATE_CONCURRENCY)")
+    parser.add_argument('--api-latency-ms', type=float, default=0, help="задержка ответа фейкового Bot API")
+    parser.add_argument('--db', choices=('sqlite', 'memory', 'mysql'), default='sqlite', help="база данных для прогона")
+    parser.add_argument('--min-throughput', type=float, default=0,
+                        help="завершиться с ошибкой, если обн/сек меньше этого значения")
+    parser.add_argument('--verbose', action='store_true', help="не скрывать логи обработчиков")
+    args = parser.parse_args(argv)
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    throughput = asyncio.run(run_benchmark(arguments))
+    if throughput < arguments.min_throughput:
+        print(f"Пропускная способность ниже порога {arguments.min_throughput} обн/сек")
+        sys.exit(1)
@@ -0,0 +1,118 @@
+"""
+Рассылка сообщения всем пользователям, писавшим в поддержку.
+Получатели читаются страницами по возрастанию user_id, сообщение копируется не более
+чем в concurrency чатов одновременно с низшим приоритетом планировщика исходящих запросов.
+После каждой группы отправок прогресс сохраняется в таблице broadcasts, поэтому
+после перезапуска рассылка продолжается с места остановки.
+"""
+import asyncio
+import logging
+
+from telegram.error import Forbidden
+
+from db_async import create_broadcast, get_running_broadcasts, get_broadcast_recipients, save_broadcast_progress
+from outbound import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastManager:
+    """Запускает, продолжает и останавливает рассылки этой реплики"""
+
+    def __init__(self, report_chat_id, concurrency, page_size, replica=0):
+        self.report_chat_id = report_chat_id
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.replica = replica
+        self._tasks = {}
+        self._cancelled = set()
+
+    async def start(self, bot, from_chat_id, message_id):
+        """Создает рассылку сообщения message_id из чата from_chat_id и возвращает ее номер"""
+        broadcast = await create_broadcast(from_chat_id, message_id, self.replica)
+        self._spawn(bot, broadcast)
+        return broadcast.id
+
+    async def resume(self, bot):
+        """Продолжает рассылки, прерванные остановкой бота"""
+        for broadcast in await get_running_broadcasts(self.replica):
+            logger.info(f"Продолжение рассылки #{broadcast.id} после user_id {broadcast.last_user_id}")
+            self._spawn(bot, broadcast)
+
+    def cancel_all(self):
+        """Останавливает активные рассылки после текущей группы отправок; возвращает их количество"""
+        self._cancelled.update(self._tasks)
+        return len(self._tasks)
+
+    async def stop(self):
+        """Прерывает рассылки при остановке бота; они продолжатся после запуска"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, bot, broadcast):
+        task = asyncio.create_task(self._run(bot, broadcast))
+        self._tasks[broadcast.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast.id, None))
+
+    async def _deliver(self, bot, broadcast, user_id):
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=broadcast.from_chat_id,
+                                   message_id=broadcast.message_id, rate_limit_args=PRIORITY_BULK)
+            return 'delivered'
+        except Forbidden:
+            # Пользователь заблокировал бота или удалил аккаунт
+            return 'blocked'
+        except Exception as e:
+            logger.warning(f"Рассылка #{broadcast.id}: не удалось отправить пользователю {user_id}: {e}")
+            return 'failed'
+
+    async def _save(self, broadcast, status='running'):
+        await save_broadcast_progress(broadcast.id, broadcast.last_user_id, broadcast.delivered,
+                                      broadcast.failed, broadcast.blocked, status)
+
+    async def _send_pages(self, bot, broadcast):
+        """Отправляет страницы получателей; возвращает False, если рассылку остановили"""
+        while True:
+            recipients = await get_broadcast_recipients(broadcast.last_user_id, self.page_size)
+            for start in range(0, len(recipients), self.concurrency):
+                if broadcast.id in self._cancelled:
+                    return False
+                chunk = recipients[start:start + self.concurrency]
+                for result in await asyncio.gather(*(self._deliver(bot, broadcast, user_id) for user_id in chunk)):
+                    setattr(broadcast, result, getattr(broadcast, result) + 1)
+                broadcast.last_user_id = chunk[-1]
+                await self._save(broadcast)
+            if len(recipients) < self.page_size:
+                return True
+
+    async def _report(self, bot, text):
+        try:
+            await bot.send_message(chat_id=self.report_chat_id, text=text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчет о рассылке: {e}")
+
+    async def _run(self, bot, broadcast):
+        try:
+            completed = await self._send_pages(bot, broadcast)
+            await self._save(broadcast, 'done' if completed else 'cancelled')
+        except asyncio.CancelledError:
+            logger.info(f"Рассылка #{broadcast.id} прервана остановкой бота, прогресс сохранен")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при рассылке #{broadcast.id}: {e}")
+            await self._report(bot, f"Рассылка #{broadcast.id} прервана ошибкой: {e}. "
+                                    f"Она продолжится после перезапуска бота")
+            return
+        finally:
+            self._cancelled.discard(broadcast.id)
+
+        report = (f"Рассылка #{broadcast.id} {'завершена' if completed else 'остановлена'}: "
+                  f"доставлено {broadcast.delivered}, не доставлено {broadcast.failed}, "
+                  f"заблокировали бота {broadcast.blocked}")
+        logger.info(report)
+        await self._report(bot, report)
+
+    def __len__(self):
+        return len(self._tasks)
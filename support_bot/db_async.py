@@ -0,0 +1,89 @@
+"""
+Асинхронный слой доступа к базе данных.
+Синхронные функции db_connector выполняются в ограниченном пуле потоков,
+поэтому запрос к MySQL не блокирует цикл событий бота.
+"""
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db_connector
+from metrics import db_call_duration, db_call_wait, db_call_errors
+from settings import DB_EXECUTOR_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _timed(func):
+    """Измеряет время ожидания потока и выполнения функции db_connector"""
+    name = func.__name__
+
+    def call(queued_at, *args, **kwargs):
+        started = time.perf_counter()
+        db_call_wait.observe(started - queued_at, name)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            db_call_errors.inc(name)
+            raise
+        finally:
+            db_call_duration.observe(time.perf_counter() - started, name)
+    return call
+
+
+def _make_async(func):
+    """Создает асинхронную версию функции db_connector с той же сигнатурой"""
+    timed_func = _timed(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db_executor(timed_func, time.perf_counter(), *args, **kwargs)
+    return wrapper
+
+
+create_message_in_db = _make_async(db_connector.create_message_in_db)
+get_message_id_from_db = _make_async(db_connector.get_message_id_from_db)
+remove_message_from_db = _make_async(db_connector.remove_message_from_db)
+set_last_reply_time = _make_async(db_connector.set_last_reply_time)
+get_last_reply_time = _make_async(db_connector.get_last_reply_time)
+set_new_banned_user = _make_async(db_connector.set_new_banned_user)
+remove_banned_user = _make_async(db_connector.remove_banned_user)
+get_banned_users = _make_async(db_connector.get_banned_users)
+count_messages_in_period = _make_async(db_connector.count_messages_in_period)
+is_not_to_many_messages_in_period = _make_async(db_connector.is_not_to_many_messages_in_period)
+get_chat_id_by_full_name_and_date = _make_async(db_connector.get_chat_id_by_full_name_and_date)
+create_forwarded_message_in_db = _make_async(db_connector.create_forwarded_message_in_db)
+get_forwarded_message_from_db = _make_async(db_connector.get_forwarded_message_from_db)
+claim_admin_reply = _make_async(db_connector.claim_admin_reply)
+release_admin_reply = _make_async(db_connector.release_admin_reply)
+create_ban_event = _make_async(db_connector.create_ban_event)
+get_ban_events = _make_async(db_connector.get_ban_events)
+get_last_ban_event_id = _make_async(db_connector.get_last_ban_event_id)
+increment_rate_counter = _make_async(db_connector.increment_rate_counter)
+remove_obsolete_shared_state = _make_async(db_connector.remove_obsolete_shared_state)
+delete_obsolete_batch = _make_async(db_connector.delete_obsolete_batch)
+ping_database = _make_async(db_connector.ping_database)
+get_broadcast_recipients = _make_async(db_connector.get_broadcast_recipients)
+create_broadcast = _make_async(db_connector.create_broadcast)
+get_running_broadcasts = _make_async(db_connector.get_running_broadcasts)
+save_broadcast_progress = _make_async(db_connector.save_broadcast_progress)
+
+
+def shutdown_db_executor(wait=True):
+    """Останавливает пул потоков БД и закрывает соединения пула"""
+    logger.info("Остановка пула потоков базы данных...")
+    _executor.shutdown(wait=wait)
+    # Записываем в БД сообщения, оставшиеся в буфере отложенной записи
+    db_connector.close_message_buffer()
+    logger.info(f"Статистика пула соединений: {db_connector.get_pool_stats()}")
+    db_connector.close_pool()
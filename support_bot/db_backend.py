@@ -0,0 +1,49 @@
+"""
+Выбор хранилища данных по настройке DB_BACKEND.
+mysql — сервер MySQL, sqlite — файл SQLite в режиме WAL,
+memory — база SQLite в памяти процесса (для тестов и нагрузочных прогонов).
+"""
+from peewee import MySQLDatabase
+
+from db_pool import StatsPooledMySQLDatabase, StatsPooledSqliteDatabase, SharedMemorySqliteDatabase
+from settings import (DB_BACKEND, DB_USER, DB_HOST, DB_NAME, DB_PASSWORD, DB_SQLITE_PATH,
+                      DB_POOL_MAX_CONNECTIONS, DB_POOL_WAIT_TIMEOUT, DB_POOL_IDLE_TIMEOUT, DB_POOL_STALE_TIMEOUT)
+
+BACKENDS = ('mysql', 'sqlite', 'memory')
+
+# WAL позволяет читать параллельно с записью, busy_timeout — ждать освобождения записи
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+}
+
+
+def create_database():
+    """Создает пул соединений с выбранным хранилищем"""
+    pool_options = dict(
+        max_connections=DB_POOL_MAX_CONNECTIONS,
+        timeout=DB_POOL_WAIT_TIMEOUT,
+        stale_timeout=DB_POOL_STALE_TIMEOUT,
+        idle_timeout=DB_POOL_IDLE_TIMEOUT
+    )
+    if DB_BACKEND == 'mysql':
+        return StatsPooledMySQLDatabase(
+            DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            host=DB_HOST,
+            charset='utf8mb4',  # Добавляем поддержку utf8mb4
+            **pool_options
+        )
+    if DB_BACKEND == 'sqlite':
+        return StatsPooledSqliteDatabase(DB_SQLITE_PATH, pragmas=SQLITE_PRAGMAS, check_same_thread=False,
+                                         **pool_options)
+    if DB_BACKEND == 'memory':
+        return SharedMemorySqliteDatabase(DB_NAME or 'support_bot', **pool_options)
+    raise ValueError(f"Неизвестное хранилище DB_BACKEND={DB_BACKEND}, допустимые значения: {', '.join(BACKENDS)}")
+
+
+def is_mysql(dbhandle):
+    """Проверяет, что база данных работает на MySQL"""
+    return isinstance(dbhandle, MySQLDatabase)
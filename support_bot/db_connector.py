@@ -1,16 +1,14 @@
+import contextlib
 import datetime
 from peewee import *
-from settings import (MESSAGE_COUNT_PERIOD, COUNT_OF_MESSAGES_IN_PERIOD, DB_USER,
-                      DB_HOST, DB_NAME, DB_PASSWORD)
-
-dbhandle = MySQLDatabase(
-    DB_NAME, 
-    user=DB_USER,
-    password=DB_PASSWORD,
-    host=DB_HOST,
-    charset='utf8mb4'  # Добавляем поддержку utf8mb4
-)
+from db_backend import create_database, is_mysql
+from write_buffer import WriteBehindBuffer
+from settings import (MESSAGE_COUNT_PERIOD, COUNT_OF_MESSAGES_IN_PERIOD, WRITE_BEHIND_ENABLED,
+                      WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_DELAY_MS, WRITE_BEHIND_MAX_PENDING)
 
+# Соединения берутся из общего пула: close() в функциях ниже возвращает
+# соединение в пул, а не разрывает его. Хранилище выбирается настройкой DB_BACKEND
+dbhandle = create_database()
 
 class Messages(Model):
     class Meta:
@@ -25,6 +23,15 @@ class Messages(Model):
     last_reply_time = BigIntegerField(null=True)
 
 
+class AdminReplies(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'adminreplies'
+
+    admin_message_id = BigIntegerField(primary_key=True)
+    message_date = BigIntegerField()
+
+
 class BannedUsers(Model):
     class Meta:
         database = dbhandle
@@ -36,11 +43,79 @@ class BannedUsers(Model):
     full_name = CharField()
 
 
+class ForwardedMessages(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'forwardedmessages'  # Явно указываем имя таблицы
+
+    admin_message_id = BigIntegerField(primary_key=True)
+    user_id = BigIntegerField()
+    message_id = BigIntegerField()
+    message_date = BigIntegerField()
+    user_full_name = CharField()
+    nickname = CharField(null=True)
+
+
+class BanEvents(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'banevents'  # Явно указываем имя таблицы
+
+    user_id = BigIntegerField()
+    banned = BooleanField()
+    created_at = BigIntegerField()
+
+
+class RateCounters(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'ratecounters'  # Явно указываем имя таблицы
+        primary_key = CompositeKey('user_id', 'window_start')
+
+    user_id = BigIntegerField()
+    window_start = BigIntegerField()
+    hits = IntegerField()
+
+
+class Broadcasts(Model):
+    class Meta:
+        database = dbhandle
+        table_name = 'broadcasts'  # Явно указываем имя таблицы
+
+    from_chat_id = BigIntegerField()
+    message_id = BigIntegerField()
+    replica = IntegerField()
+    status = CharField()
+    last_user_id = BigIntegerField()
+    delivered = IntegerField()
+    failed = IntegerField()
+    blocked = IntegerField()
+    created_at = BigIntegerField()
+    finished_at = BigIntegerField(null=True)
+
+
 def create_message_in_db(user_id, user_full_name, message_date, message_id):
+    """Сохраняет сообщение; возвращает False, если оно уже сохранено (повторная доставка)"""
+    if message_buffer is not None:
+        # После перезапуска кэш UpdateDeduplicator пуст, а сообщение могло быть записано в БД
+        # прошлым процессом: проверяем уникальный ключ в БД точечным запросом по idx_messages_unique.
+        # hold() не дает пакету с этим сообщением записаться между проверками БД и буфера
+        with message_buffer.hold():
+            if _message_stored(user_id, int(message_date), message_id):
+                return False
+            return message_buffer.add(
+                dict(user_id=user_id, user_full_name=user_full_name, message_date=int(message_date),
+                     message_id=message_id, last_reply_time=None),
+                unless=lambda row: row['user_id'] == user_id and row['message_date'] == int(message_date)
+                and row['message_id'] == message_id)
     try:
         dbhandle.connect(reuse_if_open=True)
         Messages.create(user_id=user_id, user_full_name=user_full_name,
                         message_date=message_date, message_id=message_id, last_reply_time=None)
+        return True
+    except IntegrityError:
+        # Уникальный индекс idx_messages_unique: сообщение уже сохранено
+        return False
     except Exception as e:
         raise e
     finally:
@@ -48,14 +123,12 @@ def create_message_in_db(user_id, user_full_name, message_date, message_id):
             dbhandle.close()
 
 
-def get_message_id_from_db(user_id, message_date):
+def insert_messages_batch(rows):
     try:
         dbhandle.connect(reuse_if_open=True)
-        message_id = 0
-        for i in Messages.select(Messages.message_id).where((Messages.user_id == user_id) &
-                                                            (Messages.message_date == message_date)):
-            message_id = i.message_id
-        return message_id
+        with dbhandle.atomic():
+            # Повторы, уже записанные в БД, пропускаются уникальным индексом
+            Messages.insert_many(rows).on_conflict_ignore().execute()
     except Exception as e:
         raise e
     finally:
@@ -63,11 +136,18 @@ def get_message_id_from_db(user_id, message_date):
             dbhandle.close()
 
 
-def remove_message_from_db(user_id):
+# Буфер отложенной записи сообщений; None, если запись сразу идет в БД
+message_buffer = (WriteBehindBuffer(insert_messages_batch, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_DELAY_MS / 1000,
+                                    WRITE_BEHIND_MAX_PENDING)
+                  if WRITE_BEHIND_ENABLED else None)
+
+
+def _message_stored(user_id, message_date, message_id):
+    """Записано ли сообщение в БД (поиск по уникальному индексу)"""
     try:
         dbhandle.connect(reuse_if_open=True)
-        query = Messages.delete().where(Messages.user_id == user_id)
-        query.execute()
+        return Messages.select().where((Messages.user_id == user_id) & (Messages.message_date == message_date) &
+                                       (Messages.message_id == message_id)).exists()
     except Exception as e:
         raise e
     finally:
@@ -75,12 +155,25 @@ def remove_message_from_db(user_id):
             dbhandle.close()
 
 
-def set_last_reply_time(user_id, message_date, last_reply_time):
+def _find_buffered_message(predicate):
+    return message_buffer.find_last(predicate) if message_buffer is not None else None
+
+
+def _hold_message_buffer():
+    return message_buffer.hold() if message_buffer is not None else contextlib.nullcontext()
+
+
+def get_message_id_from_db(user_id, message_date):
+    buffered = _find_buffered_message(lambda row: row['user_id'] == user_id and row['message_date'] == message_date)
+    if buffered is not None:
+        return buffered['message_id']
     try:
         dbhandle.connect(reuse_if_open=True)
-        query = Messages.update(last_reply_time=last_reply_time).where((Messages.user_id == user_id) &
-                                                                       (Messages.message_date == message_date))
-        query.execute()
+        message = (Messages.select(Messages.message_id)
+                   .where((Messages.user_id == user_id) & (Messages.message_date == message_date))
+                   .order_by(Messages.id.desc())
+                   .first())
+        return message.message_id if message else 0
     except Exception as e:
         raise e
     finally:
@@ -88,14 +181,49 @@ def set_last_reply_time(user_id, message_date, last_reply_time):
             dbhandle.close()
 
 
+def remove_message_from_db(user_id):
+    with _hold_message_buffer():
+        if message_buffer is not None:
+            message_buffer.remove(lambda row: row['user_id'] == user_id)
+        try:
+            dbhandle.connect(reuse_if_open=True)
+            query = Messages.delete().where(Messages.user_id == user_id)
+            query.execute()
+        except Exception as e:
+            raise e
+        finally:
+            if not dbhandle.is_closed():
+                dbhandle.close()
+
+
+def set_last_reply_time(user_id, message_date, last_reply_time):
+    with _hold_message_buffer():
+        if message_buffer is not None:
+            message_buffer.update(lambda row: row['user_id'] == user_id and row['message_date'] == message_date,
+                                  last_reply_time=last_reply_time)
+        try:
+            dbhandle.connect(reuse_if_open=True)
+            query = Messages.update(last_reply_time=last_reply_time).where((Messages.user_id == user_id) &
+                                                                           (Messages.message_date == message_date))
+            query.execute()
+        except Exception as e:
+            raise e
+        finally:
+            if not dbhandle.is_closed():
+                dbhandle.close()
+
+
 def get_last_reply_time(user_id, message_date):
+    buffered = _find_buffered_message(lambda row: row['user_id'] == user_id and row['message_date'] == message_date)
+    if buffered is not None:
+        return buffered['last_reply_time']
     try:
         dbhandle.connect(reuse_if_open=True)
-        last_reply_time = None
-        for i in Messages.select(Messages.last_reply_time).where((Messages.user_id == user_id) &
-                                                                 (Messages.message_date == message_date)):
-            last_reply_time = i.last_reply_time
-        return last_reply_time
+        message = (Messages.select(Messages.last_reply_time)
+                   .where((Messages.user_id == user_id) & (Messages.message_date == message_date))
+                   .order_by(Messages.id.desc())
+                   .first())
+        return message.last_reply_time if message else None
     except Exception as e:
         raise e
     finally:
@@ -114,6 +242,17 @@ def set_new_banned_user(user_id, nickname, full_name):
             dbhandle.close()
 
 
+def remove_banned_user(user_id):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        BannedUsers.delete().where(BannedUsers.user_id == user_id).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
 def get_banned_users():
     try:
         dbhandle.connect(reuse_if_open=True)
@@ -126,15 +265,39 @@ def get_banned_users():
             dbhandle.close()
 
 
+def count_messages_in_period(user_id):
+    edge = datetime.datetime.now().timestamp() - MESSAGE_COUNT_PERIOD
+    # Оба подсчета под hold(): запись пакета между ними посчитала бы одни строки дважды
+    with _hold_message_buffer():
+        buffered_count = (message_buffer.count(lambda row: row['user_id'] == user_id and row['message_date'] > edge)
+                          if message_buffer is not None else 0)
+        try:
+            dbhandle.connect(reuse_if_open=True)
+            return buffered_count + Messages.select().where((Messages.user_id == user_id) &
+                                                            (Messages.message_date > edge)).count()
+        except Exception as e:
+            raise e
+        finally:
+            if not dbhandle.is_closed():
+                dbhandle.close()
+
+
 def is_not_to_many_messages_in_period(user_id):
+    return count_messages_in_period(user_id) <= COUNT_OF_MESSAGES_IN_PERIOD
+
+
+def get_chat_id_by_full_name_and_date(user_full_name, message_date):
+    buffered = _find_buffered_message(lambda row: row['user_full_name'] == user_full_name and
+                                      row['message_date'] == message_date)
+    if buffered is not None:
+        return buffered['user_id']
     try:
         dbhandle.connect(reuse_if_open=True)
-        count = 0
-        for i in Messages.select().where((Messages.user_id == user_id) &
-                                         (Messages.message_date > (datetime.datetime.now().timestamp() -
-                                                                   MESSAGE_COUNT_PERIOD))):
-            count += 1
-        return count <= COUNT_OF_MESSAGES_IN_PERIOD
+        message = (Messages.select(Messages.user_id)
+                   .where((Messages.message_date == message_date) & (Messages.user_full_name == user_full_name))
+                   .order_by(Messages.id.desc())
+                   .first())
+        return message.user_id if message else None
     except Exception as e:
         raise e
     finally:
@@ -142,16 +305,238 @@ def is_not_to_many_messages_in_period(user_id):
             dbhandle.close()
 
 
-def get_chat_id_by_full_name_and_date(user_full_name, message_date):
+def create_forwarded_message_in_db(admin_message_id, user_id, message_id, message_date, user_full_name, nickname):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        ForwardedMessages.insert(admin_message_id=admin_message_id, user_id=user_id, message_id=message_id,
+                                 message_date=message_date, user_full_name=user_full_name,
+                                 nickname=nickname).on_conflict_replace().execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def claim_admin_reply(admin_message_id, message_date):
+    """Отмечает сообщение админа обработанным; возвращает False, если оно уже обработано (повторная доставка)"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        AdminReplies.create(admin_message_id=admin_message_id, message_date=message_date)
+        return True
+    except IntegrityError:
+        return False
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def release_admin_reply(admin_message_id):
+    """Снимает отметку, чтобы повторная доставка сообщения админа снова его обработала"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        AdminReplies.delete().where(AdminReplies.admin_message_id == admin_message_id).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_forwarded_message_from_db(admin_message_id):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return ForwardedMessages.get_or_none(ForwardedMessages.admin_message_id == admin_message_id)
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def create_ban_event(user_id, banned):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return BanEvents.insert(user_id=user_id, banned=banned,
+                                created_at=int(datetime.datetime.now().timestamp())).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_ban_events(after_id, limit=1000):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return [(event.id, event.user_id, event.banned) for event in
+                BanEvents.select().where(BanEvents.id > after_id).order_by(BanEvents.id).limit(limit)]
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_last_ban_event_id():
     try:
         dbhandle.connect(reuse_if_open=True)
-        chat_id = None
-        for i in Messages.select(Messages.user_id).where((Messages.user_full_name == user_full_name) &
-                                                         (Messages.message_date == message_date)):
-            chat_id = i.user_id
-        return chat_id
+        return BanEvents.select(fn.MAX(BanEvents.id)).scalar() or 0
     except Exception as e:
         raise e
     finally:
         if not dbhandle.is_closed():
             dbhandle.close()
+
+
+def increment_rate_counter(user_id, window_start):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        update = {RateCounters.hits: RateCounters.hits + 1}
+        query = RateCounters.insert(user_id=user_id, window_start=window_start, hits=1)
+        if is_mysql(dbhandle):
+            query = query.on_conflict(update=update)
+        else:
+            query = query.on_conflict(conflict_target=[RateCounters.user_id, RateCounters.window_start],
+                                      update=update)
+        with dbhandle.atomic():
+            query.execute()
+            return RateCounters.select(RateCounters.hits).where(
+                (RateCounters.user_id == user_id) & (RateCounters.window_start == window_start)
+            ).scalar()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def remove_obsolete_shared_state(rate_edge, events_edge):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        RateCounters.delete().where(RateCounters.window_start < rate_edge).execute()
+        BanEvents.delete().where(BanEvents.created_at < events_edge).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_broadcast_recipients(after_user_id, limit):
+    """Следующая страница получателей рассылки: пользователи из messages, кроме заблокированных,
+    по возрастанию user_id (ключ продолжения — последний user_id предыдущей страницы)"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        query = (Messages.select(Messages.user_id).distinct()
+                 .where((Messages.user_id > after_user_id) &
+                        Messages.user_id.not_in(BannedUsers.select(BannedUsers.user_id)))
+                 .order_by(Messages.user_id)
+                 .limit(limit))
+        return [user_id for user_id, in query.tuples()]
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def create_broadcast(from_chat_id, message_id, replica):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return Broadcasts.create(from_chat_id=from_chat_id, message_id=message_id, replica=replica,
+                                 status='running', last_user_id=0, delivered=0, failed=0, blocked=0,
+                                 created_at=int(datetime.datetime.now().timestamp()))
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_running_broadcasts(replica):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return list(Broadcasts.select().where((Broadcasts.status == 'running') & (Broadcasts.replica == replica))
+                    .order_by(Broadcasts.id))
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def save_broadcast_progress(broadcast_id, last_user_id, delivered, failed, blocked, status='running'):
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        finished_at = int(datetime.datetime.now().timestamp()) if status != 'running' else None
+        Broadcasts.update(last_user_id=last_user_id, delivered=delivered, failed=failed, blocked=blocked,
+                          status=status, finished_at=finished_at).where(Broadcasts.id == broadcast_id).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def _obsolete_rows(table, edge):
+    """Модель, условие отбора и поле упорядочивания устаревших строк таблицы table"""
+    if table == 'messages':
+        return (Messages, Messages.last_reply_time.is_null(False) & (Messages.last_reply_time < edge),
+                Messages.last_reply_time)
+    if table == 'adminreplies':
+        return AdminReplies, AdminReplies.message_date < edge, AdminReplies.message_date
+    return ForwardedMessages, ForwardedMessages.message_date < edge, ForwardedMessages.message_date
+
+
+def delete_obsolete_batch(table, edge, batch_size):
+    """Удаляет до batch_size строк таблицы messages, forwardedmessages или adminreplies старше edge"""
+    model, condition, order_by = _obsolete_rows(table, edge)
+    primary_key = model._meta.primary_key
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        # Выбираем пакет по индексу поля order_by и удаляем его по первичному ключу,
+        # чтобы каждая транзакция держала блокировки недолго
+        keys = [key for key, in model.select(primary_key).where(condition)
+                .order_by(order_by).limit(batch_size).tuples()]
+        if not keys:
+            return 0
+        return model.delete().where(primary_key.in_(keys)).execute()
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def start_message_buffer():
+    if message_buffer is not None:
+        message_buffer.start()
+
+
+def close_message_buffer():
+    if message_buffer is not None:
+        message_buffer.close()
+
+
+def ping_database():
+    """Проверяет доступность БД простым запросом через пул соединений"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        dbhandle.execute_sql('SELECT 1').fetchone()
+        return True
+    except Exception as e:
+        raise e
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def get_pool_stats():
+    return dbhandle.stats()
+
+
+def close_pool():
+    dbhandle.close_all()
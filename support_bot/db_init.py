@@ -3,15 +3,25 @@
 Создает базу данных, таблицы и индексы при первом запуске.
 """
 import logging
+import time
 import pymysql
-from peewee import *
-from settings import DB_USER, DB_HOST, DB_NAME, DB_PASSWORD
+from peewee import OperationalError, ProgrammingError
+import db_connector
+from db_backend import is_mysql
+from partitions import get_partition_start, get_partitions_ahead
+from settings import (DB_USER, DB_HOST, DB_NAME, DB_PASSWORD, DB_BACKEND, MESSAGES_PARTITIONING,
+                      MESSAGES_PARTITIONS_AHEAD)
 
 logger = logging.getLogger(__name__)
 
+MYSQL_TABLE_OPTIONS = "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"
+
 
 def create_database_if_not_exists():
     """Создает базу данных, если она не существует"""
+    if DB_BACKEND != 'mysql':
+        # Файл SQLite и база в памяти создаются при первом подключении
+        return True
     try:
         # Подключаемся к MySQL без указания конкретной базы данных
         connection = pymysql.connect(
@@ -40,41 +50,35 @@ def create_tables_with_indexes():
     """Создает таблицы с индексами"""
     try:
         # Подключаемся к созданной базе данных
-        dbhandle = MySQLDatabase(
-            DB_NAME, 
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            charset='utf8mb4'
-        )
-        
-        dbhandle.connect()
+        dbhandle = db_connector.dbhandle
+        dbhandle.connect(reuse_if_open=True)
         
         # Создаем таблицы, если они не существуют
-        dbhandle.execute_sql("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                user_full_name VARCHAR(255) NOT NULL,
-                message_date BIGINT NOT NULL,
-                message_id BIGINT NOT NULL,
-                last_reply_time BIGINT NULL,
-                INDEX idx_user_id (user_id),
-                INDEX idx_message_date (message_date)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        """)
+        if MESSAGES_PARTITIONING != 'none' and is_mysql(dbhandle):
+            create_partitioned_messages_table(dbhandle)
+        else:
+            if MESSAGES_PARTITIONING != 'none':
+                logger.warning("Секционирование messages поддерживается только в MySQL, создается обычная таблица")
+            _create_table(dbhandle, 'messages', [
+                _auto_id_column(dbhandle),
+                'user_id BIGINT NOT NULL',
+                'user_full_name VARCHAR(255) NOT NULL',
+                'message_date BIGINT NOT NULL',
+                'message_id BIGINT NOT NULL',
+                'last_reply_time BIGINT NULL',
+            ], [('idx_user_id', ['user_id']), ('idx_message_date', ['message_date'])])
         
-        dbhandle.execute_sql("""
-            CREATE TABLE IF NOT EXISTS bannedusers (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                nickname VARCHAR(255) NULL,
-                full_name VARCHAR(255) NOT NULL,
-                INDEX idx_user_id_banned (user_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        """)
+        _create_table(dbhandle, 'bannedusers', [
+            _auto_id_column(dbhandle),
+            'user_id BIGINT NOT NULL',
+            'nickname VARCHAR(255) NULL',
+            'full_name VARCHAR(255) NOT NULL',
+        ], [('idx_user_id_banned', ['user_id'])])
         
         logger.info("Таблицы и индексы созданы успешно")
+        
+        # Применяем миграции схемы, которых еще нет в базе
+        apply_migrations(dbhandle)
         dbhandle.close()
         return True
         
@@ -83,6 +87,230 @@ def create_tables_with_indexes():
         return False
 
 
+def _auto_id_column(dbhandle):
+    """Автоинкрементный первичный ключ id в синтаксисе хранилища"""
+    if is_mysql(dbhandle):
+        return 'id INT AUTO_INCREMENT PRIMARY KEY'
+    return 'id INTEGER PRIMARY KEY AUTOINCREMENT'
+
+
+def _create_table(dbhandle, table, columns, indexes=()):
+    """Создает таблицу и ее индексы, если таблицы еще нет"""
+    if dbhandle.table_exists(table):
+        return
+    if is_mysql(dbhandle):
+        definitions = columns + [f"INDEX {name} ({', '.join(index_columns)})" for name, index_columns in indexes]
+        dbhandle.execute_sql(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definitions)}) {MYSQL_TABLE_OPTIONS}")
+        return
+    dbhandle.execute_sql(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+    for name, index_columns in indexes:
+        _create_index(dbhandle, table, name, index_columns)
+
+
+def create_partitioned_messages_table(dbhandle):
+    """Создает таблицу messages, секционированную по message_date"""
+    if dbhandle.table_exists('messages'):
+        # Перевод существующей таблицы требует ее полного копирования, поэтому не делаем его сами
+        logger.warning("Таблица messages уже существует; секционирование применяется только к новой таблице")
+        return
+
+    # Секции на MESSAGES_PARTITIONS_AHEAD периодов вперед создаются сразу, следующие
+    # выделяет из p_future message_cleaner (maintain_partitions) по тем же правилам
+    now = time.time()
+    partitions = get_partitions_ahead(get_partition_start(now, MESSAGES_PARTITIONING), now,
+                                      MESSAGES_PARTITIONING, MESSAGES_PARTITIONS_AHEAD)
+    partitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+
+    # Ключ секционирования должен входить в каждый уникальный ключ, включая первичный
+    dbhandle.execute_sql(f"""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INT AUTO_INCREMENT,
+            user_id BIGINT NOT NULL,
+            user_full_name VARCHAR(255) NOT NULL,
+            message_date BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            last_reply_time BIGINT NULL,
+            PRIMARY KEY (id, message_date),
+            INDEX idx_user_id (user_id),
+            INDEX idx_message_date (message_date)
+        ) {MYSQL_TABLE_OPTIONS}
+        PARTITION BY RANGE (message_date) ({', '.join(partitions)})
+    """)
+    logger.info(f"Создана секционированная таблица messages (секция: {MESSAGES_PARTITIONING})")
+
+
+def _index_exists(dbhandle, table, index_name):
+    """Проверяет наличие индекса в таблице"""
+    if is_mysql(dbhandle):
+        cursor = dbhandle.execute_sql(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+            (table, index_name)
+        )
+    else:
+        cursor = dbhandle.execute_sql(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name = ?",
+            (table, index_name)
+        )
+    return cursor.fetchone()[0] > 0
+
+
+def _create_index(dbhandle, table, index_name, columns, unique=False):
+    """Создает индекс, если его еще нет"""
+    if _index_exists(dbhandle, table, index_name):
+        logger.info(f"Индекс {index_name} уже существует")
+        return
+    dbhandle.execute_sql(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {index_name} ON {table} ({', '.join(columns)})"
+    )
+    logger.info(f"Создан индекс {index_name} на {table} ({', '.join(columns)})")
+
+
+def _drop_index(dbhandle, table, index_name):
+    """Удаляет индекс, если он существует"""
+    if _index_exists(dbhandle, table, index_name):
+        if is_mysql(dbhandle):
+            dbhandle.execute_sql(f"DROP INDEX {index_name} ON {table}")
+        else:
+            # В SQLite имена индексов уникальны в пределах базы, таблица не указывается
+            dbhandle.execute_sql(f"DROP INDEX {index_name}")
+        logger.info(f"Удален индекс {index_name}")
+
+
+def _migration_user_id_message_date_index(dbhandle):
+    """Составной индекс для поиска сообщения по пользователю и дате"""
+    _create_index(dbhandle, 'messages', 'idx_user_id_message_date', ['user_id', 'message_date'])
+    # Одиночный индекс по user_id покрывается левой частью составного
+    _drop_index(dbhandle, 'messages', 'idx_user_id')
+
+
+def _migration_message_date_full_name_index(dbhandle):
+    """Покрывающий индекс для поиска пользователя со скрытой пересылкой"""
+    _create_index(dbhandle, 'messages', 'idx_message_date_full_name',
+                  ['message_date', 'user_full_name', 'user_id'])
+    # Одиночный индекс по message_date покрывается левой частью нового индекса
+    _drop_index(dbhandle, 'messages', 'idx_message_date')
+
+
+def _migration_forwarded_messages_table(dbhandle):
+    """Таблица соответствия пересланных админам сообщений и пользователей"""
+    _create_table(dbhandle, 'forwardedmessages', [
+        'admin_message_id BIGINT NOT NULL PRIMARY KEY',
+        'user_id BIGINT NOT NULL',
+        'message_id BIGINT NOT NULL',
+        'message_date BIGINT NOT NULL',
+        'user_full_name VARCHAR(255) NOT NULL',
+        'nickname VARCHAR(255) NULL',
+    ], [('idx_forwarded_message_date', ['message_date'])])
+
+
+def _migration_last_reply_time_index(dbhandle):
+    """Индекс для пакетного удаления устаревших сообщений"""
+    _create_index(dbhandle, 'messages', 'idx_last_reply_time', ['last_reply_time'])
+
+
+def _migration_shared_state_tables(dbhandle):
+    """Таблицы общего состояния реплик: события банов и счетчики частоты сообщений"""
+    _create_table(dbhandle, 'banevents', [
+        _auto_id_column(dbhandle),
+        'user_id BIGINT NOT NULL',
+        'banned SMALLINT NOT NULL',
+        'created_at BIGINT NOT NULL',
+    ], [('idx_banevents_created_at', ['created_at'])])
+    _create_table(dbhandle, 'ratecounters', [
+        'user_id BIGINT NOT NULL',
+        'window_start BIGINT NOT NULL',
+        'hits INT NOT NULL',
+        'PRIMARY KEY (user_id, window_start)',
+    ], [('idx_ratecounters_window_start', ['window_start'])])
+
+
+def _migration_messages_unique_index(dbhandle):
+    """Уникальный индекс сообщений для отбрасывания повторных доставок"""
+    # Сначала удаляем уже сохраненные повторы, оставляя первую запись.
+    # message_date входит в ключ: в секционированной таблице он обязан быть в каждом уникальном индексе
+    if is_mysql(dbhandle):
+        deleted = dbhandle.execute_sql(
+            "DELETE m1 FROM messages m1 JOIN messages m2 ON m1.user_id = m2.user_id "
+            "AND m1.message_date = m2.message_date AND m1.message_id = m2.message_id AND m1.id > m2.id"
+        ).rowcount
+    else:
+        deleted = dbhandle.execute_sql(
+            "DELETE FROM messages WHERE id NOT IN "
+            "(SELECT MIN(id) FROM messages GROUP BY user_id, message_date, message_id)"
+        ).rowcount
+    logger.info(f"Удалено повторно сохраненных сообщений: {deleted}")
+    _create_index(dbhandle, 'messages', 'idx_messages_unique', ['user_id', 'message_date', 'message_id'],
+                  unique=True)
+    # Составной индекс по пользователю и дате покрывается левой частью уникального
+    _drop_index(dbhandle, 'messages', 'idx_user_id_message_date')
+
+
+def _migration_broadcasts_table(dbhandle):
+    """Таблица рассылок с точкой продолжения после перезапуска"""
+    _create_table(dbhandle, 'broadcasts', [
+        _auto_id_column(dbhandle),
+        'from_chat_id BIGINT NOT NULL',
+        'message_id BIGINT NOT NULL',
+        'replica INT NOT NULL',
+        'status VARCHAR(16) NOT NULL',
+        'last_user_id BIGINT NOT NULL',
+        'delivered INT NOT NULL',
+        'failed INT NOT NULL',
+        'blocked INT NOT NULL',
+        'created_at BIGINT NOT NULL',
+        'finished_at BIGINT NULL',
+    ], [('idx_broadcasts_status', ['status', 'replica'])])
+
+
+def _migration_admin_replies_table(dbhandle):
+    """Таблица обработанных сообщений админов для отбрасывания повторных доставок"""
+    _create_table(dbhandle, 'adminreplies', [
+        'admin_message_id BIGINT NOT NULL PRIMARY KEY',
+        'message_date BIGINT NOT NULL',
+    ], [('idx_adminreplies_message_date', ['message_date'])])
+
+
+# Миграции схемы: (версия, функция). Новые миграции добавляются в конец списка
+MIGRATIONS = [
+    (1, _migration_user_id_message_date_index),
+    (2, _migration_message_date_full_name_index),
+    (3, _migration_forwarded_messages_table),
+    (4, _migration_last_reply_time_index),
+    (5, _migration_shared_state_tables),
+    (6, _migration_messages_unique_index),
+    (7, _migration_broadcasts_table),
+    (8, _migration_admin_replies_table),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(dbhandle):
+    """Возвращает текущую версию схемы базы данных"""
+    _create_table(dbhandle, 'schema_version', [
+        'version INT NOT NULL PRIMARY KEY',
+        'applied_at BIGINT NOT NULL',
+    ])
+    cursor = dbhandle.execute_sql("SELECT MAX(version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
+
+
+def apply_migrations(dbhandle):
+    """Применяет миграции схемы, версия которых больше текущей"""
+    current_version = get_schema_version(dbhandle)
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"Применение миграции схемы #{version}: {migration.__doc__}")
+        migration(dbhandle)
+        dbhandle.execute_sql(
+            f"INSERT INTO schema_version (version, applied_at) VALUES ({dbhandle.param}, {dbhandle.param})",
+            (version, int(time.time()))
+        )
+    logger.info(f"Версия схемы базы данных: {max(current_version, LATEST_SCHEMA_VERSION)}")
+
+
 def initialize_database():
     """Полная инициализация базы данных"""
     logger.info("Начинаем инициализацию базы данных...")
@@ -101,51 +329,88 @@ def initialize_database():
     return True
 
 
+# Коды ошибок MySQL: неизвестная база данных и отсутствующая таблица
+MYSQL_UNKNOWN_DATABASE = 1049
+MYSQL_NO_SUCH_TABLE = 1146
+
+
+def _is_missing_schema_error(error):
+    """Ошибка означает, что базы или таблицы schema_version еще нет (а не сбой соединения)"""
+    # peewee оборачивает ошибку драйвера, сохраняя ее первым аргументом
+    original = error.args[0] if error.args and isinstance(error.args[0], Exception) else error
+    code = original.args[0] if original.args else None
+    if isinstance(code, int):
+        return code in (MYSQL_UNKNOWN_DATABASE, MYSQL_NO_SUCH_TABLE)
+    return 'no such table' in str(original)
+
+
+def _read_schema_version(dbhandle):
+    """Версия схемы или None, если базы или таблицы schema_version еще нет.
+    Остальные ошибки (соединение, авторизация) пробрасываются, чтобы подготовку повторили"""
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        return dbhandle.execute_sql("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    except (OperationalError, ProgrammingError) as e:
+        if not _is_missing_schema_error(e):
+            raise
+        logger.info(f"Версия схемы не прочитана: {e}")
+        return None
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
+def prepare_database():
+    """Быстрая подготовка базы при старте: применяет только недостающие миграции.
+    Полная инициализация выполняется, только если версия схемы еще не сохранена"""
+    dbhandle = db_connector.dbhandle
+    version = _read_schema_version(dbhandle)
+    if version is None:
+        logger.info("Схема базы данных не найдена, выполняется полная инициализация")
+        return initialize_database()
+    if version >= LATEST_SCHEMA_VERSION:
+        logger.info(f"Схема базы данных актуальна (версия {version})")
+        return True
+    try:
+        dbhandle.connect(reuse_if_open=True)
+        apply_migrations(dbhandle)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при применении миграций схемы: {e}")
+        return False
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
+
+
 def check_database_connection():
     """Проверяет подключение к базе данных"""
+    dbhandle = db_connector.dbhandle
     try:
-        # Используем pymysql для более простой проверки
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        dbhandle.connect(reuse_if_open=True)
         
-        with connection.cursor() as cursor:
-            # Проверяем существование таблиц
-            cursor.execute("SHOW TABLES")
-            tables_result = cursor.fetchall()
-            
-            # Извлекаем имена таблиц из результата
-            table_names = []
-            for table_row in tables_result:
-                # В результате SHOW TABLES первое (и единственное) значение - это имя таблицы
-                table_name = list(table_row.values())[0]
-                table_names.append(table_name)
-            
-            logger.info(f"Найденные таблицы: {table_names}")
-            
-            required_tables = ['messages', 'bannedusers']
-            missing_tables = [table for table in required_tables if table not in table_names]
-            
-            if missing_tables:
-                logger.warning(f"Отсутствуют таблицы: {missing_tables}")
-                connection.close()
-                return False
-            
-            # Дополнительная проверка: попробуем выполнить простой запрос к каждой таблице
-            for table in required_tables:
-                cursor.execute(f"SELECT COUNT(*) as count FROM {table}")
-                result = cursor.fetchone()
-                logger.info(f"Таблица {table}: {result['count']} записей")
+        # Проверяем существование таблиц
+        table_names = dbhandle.get_tables()
+        logger.info(f"Найденные таблицы: {table_names}")
+        
+        required_tables = ['messages', 'bannedusers']
+        missing_tables = [table for table in required_tables if table not in table_names]
+        
+        if missing_tables:
+            logger.warning(f"Отсутствуют таблицы: {missing_tables}")
+            return False
+        
+        # Дополнительная проверка: простой запрос к каждой таблице (без подсчета всех строк)
+        for table in required_tables:
+            dbhandle.execute_sql(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            logger.info(f"Таблица {table} доступна")
         
-        connection.close()
         logger.info("Подключение к базе данных и проверка таблиц прошли успешно")
         return True
         
     except Exception as e:
         logger.error(f"Ошибка при проверке подключения к базе данных: {e}")
         return False
+    finally:
+        if not dbhandle.is_closed():
+            dbhandle.close()
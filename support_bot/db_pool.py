@@ -0,0 +1,155 @@
+"""
+Пулы соединений с базой данных.
+Расширяют пулы peewee: закрывают соединения, простаивающие дольше заданного
+времени, и собирают статистику использования пула.
+"""
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class StatsPoolMixin:
+    """Таймаут простоя и статистика для пулов соединений peewee"""
+
+    def __init__(self, database, idle_timeout=None, **kwargs):
+        self._idle_timeout = idle_timeout
+        self._returned_at = {}
+        self._stats_lock = threading.Lock()
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._created = 0
+        self._recycled = 0
+        super().__init__(database, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        started = time.monotonic()
+        result = super().connect(reuse_if_open)
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self._waits += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+        return result
+
+    def _connect(self):
+        with self._pool_lock:
+            self._close_idle_expired()
+            pooled = {self.conn_key(c) for _, c in self._connections}
+            conn = super()._connect()
+            key = self.conn_key(conn)
+            self._returned_at.pop(key, None)
+            if key not in pooled:
+                self._created += 1
+            return conn
+
+    def _close(self, conn, close_conn=False):
+        with self._pool_lock:
+            key = self.conn_key(conn)
+            returning = not close_conn and key in self._in_use
+            super()._close(conn, close_conn)
+            if returning and any(self.conn_key(c) == key for _, c in self._connections):
+                self._returned_at[key] = time.monotonic()
+                return
+            self._returned_at.pop(key, None)
+            if close_conn or returning:
+                # Соединение закрыто: устарело, простаивало или было сброшено
+                self._recycled += 1
+
+    def _close_idle_expired(self):
+        """Закрывает соединения, простаивающие в пуле дольше idle_timeout"""
+        if not self._idle_timeout:
+            return
+        edge = time.monotonic() - self._idle_timeout
+        alive = []
+        for ts, conn in self._connections:
+            key = self.conn_key(conn)
+            if self._returned_at.get(key, edge) < edge:
+                self._close(conn, True)
+            else:
+                alive.append((ts, conn))
+        if len(alive) != len(self._connections):
+            heapq.heapify(alive)
+            self._connections = alive
+
+    def stats(self):
+        """Возвращает статистику пула соединений"""
+        with self._pool_lock, self._stats_lock:
+            return {
+                'max_connections': self._max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'created': self._created,
+                'recycled': self._recycled,
+                'checkouts': self._waits,
+                'wait_time_avg': self._wait_time_total / self._waits if self._waits else 0.0,
+                'wait_time_max': self._wait_time_max,
+            }
+
+
+class StatsPooledMySQLDatabase(StatsPoolMixin, PooledMySQLDatabase):
+    """Пул соединений MySQL с таймаутом простоя и статистикой"""
+
+
+class StatsPooledSqliteDatabase(StatsPoolMixin, PooledSqliteDatabase):
+    """Пул соединений SQLite с таймаутом простоя и статистикой"""
+
+
+class SharedMemorySqliteDatabase(StatsPooledSqliteDatabase):
+    """База SQLite в памяти процесса, общая для всех соединений пула.
+    Соединения работают через общий кэш, поэтому запись сериализуется блокировкой,
+    а чтение идет без блокировок таблиц (read_uncommitted)"""
+
+    def __init__(self, name, **kwargs):
+        uri = f'file:{name}?mode=memory&cache=shared'
+        pragmas = dict(kwargs.pop('pragmas', None) or {}, read_uncommitted=1)
+        super().__init__(uri, uri=True, check_same_thread=False, pragmas=pragmas, **kwargs)
+        self._write_lock = threading.RLock()
+        # Держит ли текущий поток блокировку записи с начала своей транзакции (begin)
+        self._transaction_lock = threading.local()
+        # База в памяти существует, пока открыто хотя бы одно соединение с ней
+        self._keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    @staticmethod
+    def _is_read(sql):
+        return sql.lstrip()[:6].upper() == 'SELECT'
+
+    def execute_sql(self, sql, params=None, commit=None):
+        if self._is_read(sql):
+            return super().execute_sql(sql, params, commit)
+        with self._write_lock:
+            return super().execute_sql(sql, params, commit)
+
+    def begin(self, lock_type=None):
+        # Блокировка удерживается до конца транзакции
+        self._write_lock.acquire()
+        try:
+            super().begin(lock_type)
+        except Exception:
+            self._write_lock.release()
+            raise
+        self._transaction_lock.held = True
+
+    def _release_transaction_lock(self):
+        # commit и rollback вызываются и вне begin(): освобождаем только свою блокировку
+        if getattr(self._transaction_lock, 'held', False):
+            self._transaction_lock.held = False
+            self._write_lock.release()
+
+    def commit(self):
+        # При ошибке фиксации блокировку освободит последующий rollback
+        result = super().commit()
+        self._release_transaction_lock()
+        return result
+
+    def rollback(self):
+        try:
+            return super().rollback()
+        finally:
+            self._release_transaction_lock()
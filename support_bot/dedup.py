@@ -0,0 +1,52 @@
+"""
+Отбрасывание повторно доставленных обновлений.
+Telegram может доставить обновление еще раз (повтор webhook, перезапуск при polling).
+Ограниченный LRU-кэш ключей update_id и (chat_id, message_id) отсекает такие повторы
+до обращений к БД и Bot API; повторы, пережившие перезапуск процесса, отсекает
+уникальный индекс таблицы messages.
+"""
+import logging
+from collections import OrderedDict
+
+from telegram.ext import ApplicationHandlerStop
+
+from metrics import duplicate_updates
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """Помнит ключи последних max_size обновлений и отбрасывает повторы"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._seen = OrderedDict()
+
+    @staticmethod
+    def _keys(update):
+        keys = [('update', update.update_id)]
+        # Только новые сообщения: правка приходит с тем же message_id, но это не повтор
+        if update.message is not None:
+            keys.append(('message', update.message.chat_id, update.message.message_id))
+        return keys
+
+    def is_duplicate(self, update):
+        """Проверяет обновление и запоминает его ключи"""
+        keys = self._keys(update)
+        duplicate = any(key in self._seen for key in keys)
+        for key in keys:
+            self._seen[key] = True
+            self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return duplicate
+
+    async def drop_duplicates(self, update, context):
+        """Обработчик группы -2: останавливает обработку повторно доставленного обновления"""
+        if self.is_duplicate(update):
+            duplicate_updates.inc('cache')
+            logger.info(f"Повторная доставка обновления {update.update_id} пропущена")
+            raise ApplicationHandlerStop
+
+    def __len__(self):
+        return len(self._seen)
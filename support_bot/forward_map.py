@@ -0,0 +1,61 @@
+"""
+Соответствие пересланных в чат админов сообщений и пользователей.
+Для каждого пересланного сообщения запоминается его ID в чате админов,
+поэтому ответ админа находит получателя одним поиском по первичному ключу.
+"""
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from db_async import create_forwarded_message_in_db, get_forwarded_message_from_db
+from settings import FORWARD_MAP_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+ForwardTarget = namedtuple('ForwardTarget', ['user_id', 'message_id', 'message_date', 'user_full_name', 'nickname'])
+
+
+class ForwardCache:
+    """LRU-кэш соответствий перед таблицей forwardedmessages"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, admin_message_id):
+        with self._lock:
+            target = self._items.get(admin_message_id)
+            if target is not None:
+                self._items.move_to_end(admin_message_id)
+            return target
+
+    def put(self, admin_message_id, target):
+        with self._lock:
+            self._items[admin_message_id] = target
+            self._items.move_to_end(admin_message_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+forward_cache = ForwardCache(FORWARD_MAP_CACHE_SIZE)
+
+
+async def remember_forward(admin_message_id, target):
+    """Сохраняет соответствие пересланного сообщения и пользователя"""
+    forward_cache.put(admin_message_id, target)
+    await create_forwarded_message_in_db(admin_message_id, *target)
+
+
+async def resolve_forward(admin_message_id):
+    """Возвращает получателя ответа по ID сообщения в чате админов или None"""
+    target = forward_cache.get(admin_message_id)
+    if target is not None:
+        return target
+
+    row = await get_forwarded_message_from_db(admin_message_id)
+    if row is None:
+        return None
+    target = ForwardTarget(row.user_id, row.message_id, row.message_date, row.user_full_name, row.nickname)
+    forward_cache.put(admin_message_id, target)
+    return target
@@ -0,0 +1,83 @@
+"""
+Проверки здоровья бота для docker и оркестраторов.
+/healthz (живость) отвечает из цикла событий и сообщает его задержку: если цикл завис,
+запрос не получит ответа. /readyz (готовность) дополнительно проверяет пул соединений
+запросом SELECT 1 и сообщает время последнего обработанного обновления и последней очистки.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from db_async import ping_database
+from retention import retention_stats
+
+logger = logging.getLogger(__name__)
+
+
+def _age(timestamp, now):
+    return round(now - timestamp, 1) if timestamp is not None else None
+
+
+class HealthMonitor:
+    """Следит за задержкой цикла событий и отвечает на запросы живости и готовности"""
+
+    def __init__(self, max_loop_lag, db_timeout, interval=0.5):
+        self.max_loop_lag = max_loop_lag
+        self.db_timeout = db_timeout
+        self.interval = interval
+        self.loop_lag = 0.0
+        self.ready = False
+        self.update_processor = None
+        self._task = None
+
+    def start(self, update_processor=None):
+        self.update_processor = update_processor
+        self._task = asyncio.create_task(self._measure_loop_lag())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _measure_loop_lag(self):
+        """Задержка цикла — насколько позже запланированного просыпается короткий sleep"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.loop_lag = max(0.0, loop.time() - started - self.interval)
+
+    def _response(self, healthy, payload):
+        payload['status'] = 'ok' if healthy else 'fail'
+        return 200 if healthy else 503, 'application/json', json.dumps(payload) + '\n'
+
+    async def liveness(self):
+        """Обработчик /healthz"""
+        loop_ok = self.loop_lag <= self.max_loop_lag
+        return self._response(loop_ok, {'loop_lag': round(self.loop_lag, 3)})
+
+    async def readiness(self):
+        """Обработчик /readyz"""
+        now = time.time()
+        payload = {'ready': self.ready, 'loop_lag': round(self.loop_lag, 3)}
+        db_ok = False
+        started = time.perf_counter()
+        try:
+            db_ok = await asyncio.wait_for(ping_database(), self.db_timeout)
+        except asyncio.TimeoutError:
+            payload['db_error'] = f'нет ответа за {self.db_timeout} сек'
+        except Exception as e:
+            payload['db_error'] = str(e)
+        payload['db'] = 'ok' if db_ok else 'fail'
+        payload['db_ping'] = round(time.perf_counter() - started, 3)
+        last_update = self.update_processor.last_processed_at if self.update_processor is not None else None
+        payload['last_update_age'] = _age(last_update, now)
+        payload['last_retention_age'] = _age(retention_stats['last_run'], now)
+        payload['last_retention_error'] = retention_stats['last_error']
+        healthy = self.ready and db_ok and self.loop_lag <= self.max_loop_lag
+        return self._response(healthy, payload)
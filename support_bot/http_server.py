@@ -0,0 +1,47 @@
+"""
+Минимальный HTTP-сервер в цикле событий бота для служебных запросов (метрики, проверки здоровья).
+Обработчик пути — асинхронная функция без аргументов, возвращающая (код, тип содержимого, тело).
+"""
+import asyncio
+import http
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def _not_found():
+    return 404, 'text/plain; charset=utf-8', 'Not Found\n'
+
+
+def _make_connection_handler(routes):
+    async def handle_connection(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Заголовки запроса не нужны, но их необходимо дочитать
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            endpoint = _not_found
+            if len(parts) >= 2 and parts[0] == 'GET':
+                endpoint = routes.get(parts[1].split('?')[0], _not_found)
+            try:
+                status, content_type, body = await endpoint()
+            except Exception as e:
+                logger.error(f"Ошибка при обработке служебного запроса {parts[1]}: {e}")
+                status, content_type, body = 500, 'text/plain; charset=utf-8', 'Internal Server Error\n'
+            payload = body.encode('utf-8')
+            writer.write(f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle_connection
+
+
+async def start_http_server(host, port, routes):
+    """Запускает HTTP-сервер с путями routes: {путь: обработчик}"""
+    server = await asyncio.start_server(_make_connection_handler(routes), host, port)
+    logger.info(f"Служебный HTTP-сервер на {host}:{port}: {', '.join(sorted(routes))}")
+    return server
@@ -0,0 +1,100 @@
+"""
+Сборка альбомов (media group) из отдельных обновлений.
+Telegram присылает каждую часть альбома отдельным сообщением с общим media_group_id;
+части копятся короткое время и затем обрабатываются одним пакетом.
+"""
+import asyncio
+import contextlib
+import logging
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingGroup:
+    def __init__(self, key, on_complete):
+        self.key = key
+        self.on_complete = on_complete
+        self.messages = []
+        self.started = False
+        self.done = asyncio.Event()
+        self.timer = None
+
+
+class MediaGroupCollector:
+    """Собирает части альбомов и передает их обработчику после окна ожидания"""
+
+    def __init__(self, wait):
+        self.wait = wait
+        # Обработчик обновлений с очередями чатов (ChatOrderedUpdateProcessor): альбом
+        # обрабатывается в очереди своего ключа и занимает слот выполнения, как обычное обновление
+        self.update_processor = None
+        self._groups = {}
+
+    def add(self, message, on_complete, key=None):
+        """Добавляет часть альбома; on_complete(messages) вызывается один раз на альбом в очереди key"""
+        group = self._groups.get(message.media_group_id)
+        if group is None:
+            group = _PendingGroup(message.chat_id if key is None else key, on_complete)
+            self._groups[message.media_group_id] = group
+            group.timer = asyncio.create_task(self._complete_later(message.media_group_id, group))
+        group.messages.append(message)
+
+    def _ordered(self, key):
+        if self.update_processor is None:
+            return contextlib.nullcontext()
+        return self.update_processor.ordered(key)
+
+    async def _complete_later(self, media_group_id, group):
+        await asyncio.sleep(self.wait)
+        async with self._ordered(group.key):
+            await self._complete(media_group_id, group)
+
+    async def _complete(self, media_group_id, group):
+        """Обрабатывает альбом; до завершения on_complete он остается в списке ожидающих"""
+        if group.started:
+            await group.done.wait()
+            return
+        group.started = True
+        try:
+            await group.on_complete(sorted(group.messages, key=lambda message: message.message_id))
+        except Exception as e:
+            logger.error(f"Ошибка при обработке альбома {media_group_id}: {e}")
+        finally:
+            self._groups.pop(media_group_id, None)
+            group.done.set()
+
+    async def flush_key(self, key):
+        """Немедленно обрабатывает собранные альбомы очереди key.
+        Вызывается из обработчика, который уже занимает очередь key, поэтому альбомы,
+        чья обработка еще не началась, обрабатываются прямо в нем, а начатые — дожидаются.
+        Альбомы других ключей не трогаются: их очереди этот обработчик не занимает"""
+        for media_group_id, group in list(self._groups.items()):
+            if group.key != key:
+                continue
+            if not group.started:
+                # Таймер еще спит или ждет очередь: его работу выполняем здесь
+                group.timer.cancel()
+            await self._complete(media_group_id, group)
+
+    async def flush_all(self):
+        """Обрабатывает все собранные альбомы, например при остановке бота"""
+        for key in {group.key for group in self._groups.values()}:
+            await self.flush_key(key)
+
+    def __len__(self):
+        return len(self._groups)
+
+
+def get_input_media(message):
+    """Возвращает InputMedia для части альбома или None для неподдерживаемого типа"""
+    if message.photo:
+        return telegram.InputMediaPhoto(media=message.photo[-1].file_id, caption=message.caption)
+    if message.video is not None:
+        return telegram.InputMediaVideo(media=message.video.file_id, caption=message.caption)
+    if message.document is not None:
+        return telegram.InputMediaDocument(media=message.document.file_id, caption=message.caption)
+    if message.audio is not None:
+        return telegram.InputMediaAudio(media=message.audio.file_id, caption=message.caption)
+    return None
@@ -0,0 +1,153 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+Счетчики и гистограммы собираются в памяти процесса, значения очередей и пула
+считываются в момент запроса. При METRICS_PORT > 0 метрики отдаются по HTTP на /metrics.
+"""
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_gauge_callbacks = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """Монотонно растущий счетчик с метками"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labelvalues, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма длительностей с накопительными корзинами"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        """Возвращает {метки: (количество, сумма)} для сравнения двух моментов времени"""
+        with self._lock:
+            return {labelvalues: (count, total) for labelvalues, (_, total, count) in self._values.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labelvalues, (bucket_counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(self.labelnames, labelvalues, [('le', bound)])
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+                labels = _format_labels(self.labelnames, labelvalues, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def register_gauge(name, documentation, callback):
+    """Регистрирует показатель, значение которого вычисляется при запросе метрик"""
+    _gauge_callbacks.append((name, documentation, callback))
+
+
+def render_metrics():
+    """Возвращает все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, documentation, callback in _gauge_callbacks:
+        try:
+            value = callback()
+        except Exception as e:
+            logger.error(f"Ошибка при получении метрики {name}: {e}")
+            continue
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+handler_duration = Histogram('bot_handler_duration_seconds', 'Время работы обработчика', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Ошибки в обработчиках', ('handler',))
+db_call_duration = Histogram('bot_db_call_duration_seconds', 'Время выполнения функции db_connector',
+                             ('function',))
+db_call_wait = Histogram('bot_db_call_wait_seconds', 'Ожидание свободного потока БД', ('function',))
+db_call_errors = Counter('bot_db_call_errors_total', 'Ошибки функций db_connector', ('function',))
+telegram_api_duration = Histogram('bot_telegram_api_duration_seconds', 'Время запроса к Telegram Bot API',
+                                  ('method',))
+telegram_api_errors = Counter('bot_telegram_api_errors_total', 'Ошибки запросов к Telegram Bot API', ('method',))
+telegram_retry_after = Counter('bot_telegram_retry_after_total', 'Ответы RetryAfter от Telegram', ('method',))
+retention_batch_duration = Histogram('bot_retention_batch_duration_seconds',
+                                     'Время удаления одного пакета при очистке', ('table',))
+retention_deleted = Counter('bot_retention_deleted_rows_total', 'Удалено строк при очистке', ('table',))
+duplicate_updates = Counter('bot_duplicate_updates_total', 'Отброшенные повторно доставленные обновления',
+                            ('source',))
+outbound_dropped = Counter('bot_outbound_dropped_total', 'Запросов, отклоненных из-за переполнения очереди')
+
+
+def timed_handler(name):
+    """Декоратор: измеряет время работы асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                # Ошибки, перехваченные внутри обработчика, он учитывает сам
+                handler_errors.inc(name)
+                raise
+            finally:
+                handler_duration.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+async def metrics_endpoint():
+    """Обработчик пути /metrics служебного HTTP-сервера"""
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics()
@@ -0,0 +1,263 @@
+"""
+Планировщик исходящих запросов к Telegram Bot API.
+Подключается к боту как rate limiter python-telegram-bot: каждый запрос на отправку
+ждет токенов из общего ведра и ведра своего чата, а очередь ожидания упорядочена
+по приоритету, поэтому ответы админов уходят раньше уведомлений о получении.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from metrics import outbound_dropped, telegram_api_duration, telegram_api_errors, telegram_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньшее значение отправляется раньше
+PRIORITY_HIGH = 0  # ответы админов пользователям
+PRIORITY_NORMAL = 1  # пересылка админам и прочие запросы
+PRIORITY_LOW = 2  # уведомления "сообщение получено"
+PRIORITY_BULK = 3  # рассылки всем пользователям
+
+# Методы, на которые распространяются лимиты Telegram на отправку сообщений
+THROTTLED_METHOD_PREFIXES = ('send', 'forward', 'copy')
+
+
+class OutboundQueueFull(TelegramError):
+    """Очередь исходящих запросов переполнена"""
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundDispatcher(BaseRateLimiter):
+    """Приоритетная очередь исходящих запросов с лимитами на бота, чат и группу"""
+
+    def __init__(self, global_rate, chat_rate, group_rate_per_minute, burst=1, max_queue_size=1000,
+                 max_retries=3, max_buckets=10000, admin_chat_id=None, admin_chat_rate_per_minute=0,
+                 admin_chat_burst=None):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate_per_minute / 60
+        # Чат админов получает все пересылки: лимит группы Telegram действует и на него,
+        # но пачка может быть больше, чтобы всплеск обращений не копился в очереди
+        self._admin_chat_id = admin_chat_id
+        self._admin_chat_rate = (admin_chat_rate_per_minute if admin_chat_rate_per_minute > 0
+                                 else group_rate_per_minute) / 60
+        self._admin_chat_burst = admin_chat_burst or burst
+        self._burst = burst
+        self._max_queue_size = max_queue_size
+        self._max_retries = max_retries
+        self._max_buckets = max_buckets
+        self._chat_buckets = OrderedDict()
+        self._queue = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        # Пауза после RetryAfter: по чатам для отправок в чат, общая — для остальных запросов
+        self._paused_until = 0.0
+        self._chat_paused_until = {}
+        self._stats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'retry_after': 0,
+            'max_queue_depth': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, _, future in self._queue:
+            if not future.done():
+                future.set_exception(OutboundQueueFull("Планировщик исходящих запросов остановлен"))
+        self._queue = []
+        logger.info(f"Статистика исходящих запросов: {self.stats()}")
+
+    def stats(self):
+        """Возвращает статистику очереди исходящих запросов"""
+        stats = dict(self._stats)
+        stats['queue_depth'] = len(self._queue)
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+    async def _call(self, callback, args, kwargs, endpoint):
+        """Выполняет запрос к Bot API и учитывает его в метриках"""
+        if endpoint == 'getUpdates':
+            # Длинный опрос ждет обновлений, его длительность не показательна
+            return await callback(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter:
+            telegram_retry_after.inc(endpoint)
+            raise
+        except Exception:
+            telegram_api_errors.inc(endpoint)
+            raise
+        finally:
+            telegram_api_duration.observe(time.perf_counter() - started, endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(THROTTLED_METHOD_PREFIXES) or data.get('chat_id') is None:
+            try:
+                return await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as exc:
+                # Лимит не привязан к чату: приостанавливаем все отправки
+                self._stats['retry_after'] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + exc.retry_after)
+                raise
+
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        chat_id = data['chat_id']
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as exc:
+                self._stats['retry_after'] += 1
+                # Telegram просит подождать с отправками в этот чат; остальные чаты не ждут
+                self._chat_paused_until[chat_id] = max(self._chat_paused_until.get(chat_id, 0.0),
+                                                       time.monotonic() + exc.retry_after)
+                if attempt == self._max_retries:
+                    logger.error(f"Превышен лимит Telegram для {endpoint} после {attempt + 1} попыток")
+                    raise
+                logger.warning(f"Превышен лимит Telegram для {endpoint}, повтор через {exc.retry_after} сек")
+        return None
+
+    async def _acquire(self, priority, chat_id):
+        """Ставит запрос в очередь и ждет разрешения на отправку"""
+        if len(self._queue) >= self._max_queue_size:
+            self._stats['dropped'] += 1
+            outbound_dropped.inc()
+            raise OutboundQueueFull(f"Очередь исходящих запросов переполнена ({self._max_queue_size})")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), chat_id, future))
+        self._stats['queued'] += 1
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+        self._wakeup.set()
+
+        started = time.monotonic()
+        await future
+        waited = time.monotonic() - started
+        self._stats['sent'] += 1
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+    def _get_chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id == self._admin_chat_id:
+                rate = self._admin_chat_rate
+                capacity = self._admin_chat_burst
+            else:
+                is_group = isinstance(chat_id, str) or chat_id < 0
+                rate = self._group_rate if is_group else self._chat_rate
+                capacity = self._burst
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, capacity)
+            # Полные ведра не хранят информации, их можно вытеснять
+            while len(self._chat_buckets) > self._max_buckets:
+                old_chat_id, old_bucket = next(iter(self._chat_buckets.items()))
+                if not old_bucket.is_full(now):
+                    break
+                del self._chat_buckets[old_chat_id]
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _sleep(self, timeout):
+        """Ждет timeout секунд или появления нового запроса в очереди"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch_loop(self):
+        while True:
+            # Отмененные запросы (например, по таймауту обработчика) убираем из очереди
+            if any(entry[3].done() for entry in self._queue):
+                self._queue = [entry for entry in self._queue if not entry[3].done()]
+                heapq.heapify(self._queue)
+
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            # Первый по приоритету запрос, чат которого не исчерпал лимит
+            chosen = None
+            chat_delay = None
+            for entry in sorted(self._queue):
+                paused = self._chat_paused_until.get(entry[2])
+                if paused is not None:
+                    if paused > now:
+                        chat_delay = paused - now if chat_delay is None else min(chat_delay, paused - now)
+                        continue
+                    del self._chat_paused_until[entry[2]]
+                bucket = self._get_chat_bucket(entry[2], now)
+                delay = bucket.delay(now)
+                if delay == 0:
+                    chosen = entry
+                    bucket.take(now)
+                    break
+                chat_delay = delay if chat_delay is None else min(chat_delay, delay)
+
+            if chosen is None:
+                await self._sleep(chat_delay)
+                continue
+
+            self._queue.remove(chosen)
+            heapq.heapify(self._queue)
+            self._global_bucket.take(now)
+            chosen[3].set_result(None)
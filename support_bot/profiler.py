@@ -0,0 +1,101 @@
+"""
+Профилирование обработки обновлений по команде из чата админов.
+На время сеанса планировщик обновлений подменяется оберткой, которая считает обновления,
+а cProfile собирает время функций в потоке цикла событий. Время запросов к БД берется
+из метрик db_async. Вне сеанса обработка обновлений ничем не замедляется.
+"""
+import asyncio
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import time
+
+from metrics import db_call_duration
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateProfiler:
+    """Сеанс профилирования на max_updates обновлений или max_seconds секунд"""
+
+    def __init__(self, top_functions=25):
+        self.top_functions = top_functions
+        self._processor = None
+        self._profile = None
+        self._on_complete = None
+        self._timer = None
+        self._report_task = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self, processor, max_updates, max_seconds, on_complete):
+        """Начинает сеанс; on_complete(report, profile) вызывается по его завершении"""
+        if self.active:
+            raise RuntimeError("Профилирование уже запущено")
+        self._processor = processor
+        self._max_updates = max_updates
+        self._updates = 0
+        self._started = time.perf_counter()
+        self._db_snapshot = db_call_duration.snapshot()
+        self._on_complete = on_complete
+        self._timer = asyncio.get_running_loop().call_later(max_seconds, self.stop)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        # Обертка ставится только на время сеанса, вне его вызывается метод класса
+        original = processor.do_process_update
+
+        async def profiled_process_update(update, coroutine):
+            try:
+                await original(update, coroutine)
+            finally:
+                self._updates += 1
+                if self.active and self._updates >= self._max_updates:
+                    self.stop()
+        processor.do_process_update = profiled_process_update
+        logger.info(f"Профилирование запущено: {max_updates} обновлений, не дольше {max_seconds} сек")
+
+    def stop(self):
+        """Завершает сеанс и передает отчет в on_complete"""
+        if not self.active:
+            return
+        profile, self._profile = self._profile, None
+        profile.disable()
+        del self._processor.do_process_update
+        self._timer.cancel()
+        report = self._build_report(profile, time.perf_counter() - self._started)
+        logger.info(f"Профилирование завершено: {self._updates} обновлений")
+        self._report_task = asyncio.get_running_loop().create_task(self._on_complete(report, profile))
+
+    def _build_report(self, profile, elapsed):
+        stream = io.StringIO()
+        stream.write(f"Обновлений: {self._updates}, длительность: {elapsed:.1f} сек\n\n")
+
+        stream.write("Запросы к БД (вызовов, всего мс, среднее мс):\n")
+        before = self._db_snapshot
+        db_rows = []
+        for labelvalues, (count, total) in db_call_duration.snapshot().items():
+            prev_count, prev_total = before.get(labelvalues, (0, 0.0))
+            if count > prev_count:
+                db_rows.append((total - prev_total, count - prev_count, labelvalues[0]))
+        for total, count, name in sorted(db_rows, reverse=True):
+            stream.write(f"  {name}: {count}, {total * 1000:.1f}, {total * 1000 / count:.2f}\n")
+        if not db_rows:
+            stream.write("  нет\n")
+
+        stream.write(f"\nСамые затратные функции цикла событий (top {self.top_functions}):\n")
+        stats = pstats.Stats(profile, stream=stream)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self.top_functions)
+        return stream.getvalue()
+
+
+def save_profile(profile, directory):
+    """Сохраняет статистику в формате pstats и возвращает путь к файлу"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, datetime.datetime.now().strftime('profile-%Y%m%d-%H%M%S.pstats'))
+    profile.dump_stats(path)
+    return path
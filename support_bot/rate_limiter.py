@@ -0,0 +1,98 @@
+"""
+Ограничение частоты сообщений от пользователей.
+Скользящее окно по каждому пользователю хранится в памяти с LRU/TTL-вытеснением.
+К БД обращаемся одним COUNT(*) только в первые MESSAGE_COUNT_PERIOD секунд после запуска
+и только для пользователя, которого нет в памяти: позже окна в памяти полные.
+При нескольких репликах используются общие счетчики в фиксированных окнах.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from db_async import count_messages_in_period
+from shared_state import shared_store
+from settings import MESSAGE_COUNT_PERIOD, COUNT_OF_MESSAGES_IN_PERIOD, RATE_LIMITER_MAX_USERS
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindowRateLimiter:
+    """Скользящее окно отметок времени сообщений для каждого пользователя"""
+
+    def __init__(self, period, limit, max_users):
+        self.period = period
+        self.limit = limit
+        self.max_users = max_users
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        # Сообщения, отправленные до запуска, учитываются в окне не дольше одного периода
+        self.started_at = time.time()
+
+    def is_known(self, user_id):
+        return user_id in self._windows
+
+    def needs_seed(self, user_id, now=None):
+        """Нужно ли заполнить окно из БД: только при холодном старте для неизвестного пользователя.
+        После первого периода неизвестный пользователь означает пустое окно"""
+        now = now or time.time()
+        return now - self.started_at < self.period and not self.is_known(user_id)
+
+    def seed(self, user_id, count, now=None):
+        """Заполняет окно по числу сообщений из БД при холодном старте"""
+        now = now or time.time()
+        with self._lock:
+            if user_id in self._windows:
+                return
+            # Времена сообщений неизвестны, поэтому считаем их только что отправленными
+            self._windows[user_id] = deque([now] * min(count, self.limit + 1), maxlen=self.limit + 1)
+            self._evict(now)
+
+    def allow(self, user_id, now=None):
+        """Проверяет лимит и учитывает сообщение, если оно разрешено"""
+        now = now or time.time()
+        with self._lock:
+            window = self._windows.get(user_id)
+            if window is None:
+                window = self._windows[user_id] = deque(maxlen=self.limit + 1)
+            self._windows.move_to_end(user_id)
+
+            edge = now - self.period
+            while window and window[0] <= edge:
+                window.popleft()
+
+            allowed = len(window) <= self.limit
+            if allowed:
+                window.append(now)
+            self._evict(now)
+            return allowed
+
+    def _evict(self, now):
+        """Удаляет давно неактивных пользователей и ограничивает размер кэша"""
+        edge = now - self.period
+        while self._windows:
+            user_id, window = next(iter(self._windows.items()))
+            expired = not window or window[-1] <= edge
+            if not expired and len(self._windows) <= self.max_users:
+                break
+            del self._windows[user_id]
+
+    def __len__(self):
+        return len(self._windows)
+
+
+message_limiter = SlidingWindowRateLimiter(MESSAGE_COUNT_PERIOD, COUNT_OF_MESSAGES_IN_PERIOD,
+                                           RATE_LIMITER_MAX_USERS)
+
+
+async def is_not_to_many_messages_in_period(user_id):
+    """Проверяет, не превысил ли пользователь лимит сообщений за период"""
+    now = time.time()
+    if shared_store is not None:
+        # Счетчик общий для всех реплик; как и локальное окно, пропускает limit + 1 сообщений
+        window_start = int(now // MESSAGE_COUNT_PERIOD * MESSAGE_COUNT_PERIOD)
+        hits = await shared_store.increment_rate_counter(user_id, window_start)
+        return hits <= COUNT_OF_MESSAGES_IN_PERIOD + 1
+    if message_limiter.needs_seed(user_id, now):
+        message_limiter.seed(user_id, await count_messages_in_period(user_id), now)
+    return message_limiter.allow(user_id, now)
@@ -0,0 +1,96 @@
+"""
+Распределение обновлений между репликами бота.
+Каждая реплика получает обновления webhook через балансировщик и обрабатывает только те,
+ключ порядка которых (пользователь или чат) принадлежит ей по хешу. Чужие обновления
+передаются реплике-владельцу на ее адрес webhook сразу при получении, до постановки
+в очередь приложения, поэтому порядок сообщений одного пользователя сохраняется на одной
+реплике в том порядке, в котором их доставил Telegram. Если Telegram доставил два обновления
+одного пользователя разным репликам одновременно, их взаимный порядок не гарантируется.
+"""
+import asyncio
+import json
+import logging
+import zlib
+
+import httpx
+import telegram
+
+from update_processor import get_ordering_key
+
+logger = logging.getLogger(__name__)
+
+# Поле, которым реплика помечает переданное обновление; Update.de_json сохраняет
+# неизвестные поля в api_kwargs, поэтому пометка видна получателю
+FORWARDED_FIELD = 'replica_forwarded_from'
+
+
+class UpdatePartitioner:
+    """Передает обновление реплике, которой принадлежит его ключ"""
+
+    def __init__(self, peers, index, secret_token=None, timeout=10):
+        if not 0 <= index < len(peers):
+            raise ValueError(f"REPLICA_INDEX={index} вне списка REPLICA_PEERS из {len(peers)} реплик")
+        self.peers = peers
+        self.index = index
+        self._secret_token = secret_token
+        self._timeout = timeout
+        self._client = None
+        # Передачи одному владельцу идут по одной, в порядке получения обновлений
+        self._owner_locks = {}
+
+    def owner_of(self, update):
+        """Номер реплики, которая обрабатывает обновление.
+        Ключ не зависит от кэша пересылок процесса, поэтому все реплики выбирают одного владельца"""
+        key = get_ordering_key(update, use_cache=False)
+        if key is None:
+            return self.index
+        return zlib.crc32(str(key).encode()) % len(self.peers)
+
+    async def forward_if_foreign(self, update):
+        """Передает чужое обновление владельцу; возвращает False, если обновление обрабатывается здесь"""
+        if FORWARDED_FIELD in update.api_kwargs:
+            # Обновление уже передано другой репликой: повторно не передаем, даже если
+            # реплики разошлись во мнении о владельце (например, при разных REPLICA_PEERS)
+            return False
+        owner = self.owner_of(update)
+        if owner == self.index:
+            return False
+        try:
+            async with self._owner_locks.setdefault(owner, asyncio.Lock()):
+                await self._forward(self.peers[owner], update)
+        except Exception as e:
+            # Недоступность соседа не должна терять обновление: обрабатываем его сами
+            logger.warning(f"Не удалось передать обновление {update.update_id} реплике #{owner}: {e}")
+            return False
+        return True
+
+    async def _forward(self, url, update):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self._timeout)
+        headers = {'Content-Type': 'application/json', 'X-Replica-Forwarded': str(self.index)}
+        if self._secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self._secret_token
+        payload = update.to_dict()
+        payload[FORWARDED_FIELD] = self.index
+        response = await self._client.post(url, content=json.dumps(payload), headers=headers)
+        response.raise_for_status()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class RoutingUpdateQueue(asyncio.Queue):
+    """Очередь обновлений приложения: чужие обновления передаются владельцу при получении webhook,
+    до постановки в очередь и до обработчиков этой реплики"""
+
+    def __init__(self, partitioner):
+        super().__init__()
+        self._partitioner = partitioner
+
+    async def put(self, item):
+        # Кроме обновлений, приложение кладет в очередь служебные объекты (например, сигнал остановки)
+        if isinstance(item, telegram.Update) and await self._partitioner.forward_if_foreign(item):
+            return
+        await super().put(item)
@@ -0,0 +1,57 @@
+"""
+Удаление устаревших сообщений внутри процесса бота.
+Задача запускается очередью заданий python-telegram-bot с интервалом RETENTION_INTERVAL,
+удаляет небольшие пакеты через общий пул соединений и не блокирует цикл событий.
+Заменяет отдельный сервис message_cleaner в режиме удаления.
+"""
+import asyncio
+import datetime
+import logging
+import time
+
+from db_async import delete_obsolete_batch
+from metrics import retention_batch_duration, retention_deleted
+from settings import MESSAGES_TO_DELETE_HOURS, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE_MS
+
+logger = logging.getLogger(__name__)
+
+# Результаты последнего запуска очистки
+retention_stats = {
+    'last_run': None,
+    'last_deleted': 0,
+    'last_duration': 0.0,
+    'last_error': None,
+}
+
+
+async def _delete_in_batches(table, edge):
+    """Удаляет пакеты с паузой между ними, пока они полные; возвращает число удаленных строк"""
+    deleted_count = 0
+    while True:
+        started = time.perf_counter()
+        deleted = await delete_obsolete_batch(table, edge, RETENTION_BATCH_SIZE)
+        retention_batch_duration.observe(time.perf_counter() - started, table)
+        retention_deleted.inc(table, amount=deleted)
+        deleted_count += deleted
+        if deleted < RETENTION_BATCH_SIZE:
+            return deleted_count
+        await asyncio.sleep(RETENTION_BATCH_PAUSE_MS / 1000)
+
+
+async def run_retention(context):
+    """Задание очереди: удаляет устаревшие сообщения, соответствия пересылок и отметки ответов админов"""
+    started = time.monotonic()
+    edge = datetime.datetime.now().timestamp() - MESSAGES_TO_DELETE_HOURS * 3600
+    try:
+        deleted_count = await _delete_in_batches('messages', edge)
+        forwarded_count = await _delete_in_batches('forwardedmessages', edge)
+        replies_count = await _delete_in_batches('adminreplies', edge)
+
+        elapsed = time.monotonic() - started
+        retention_stats.update(last_run=time.time(), last_deleted=deleted_count, last_duration=elapsed,
+                               last_error=None)
+        logger.info(f"Очистка: удалено {deleted_count} сообщений, {forwarded_count} соответствий "
+                    f"пересылок и {replies_count} отметок ответов админов за {elapsed:.2f} сек")
+    except Exception as e:
+        retention_stats['last_error'] = str(e)
+        logger.error(f"Ошибка при удалении устаревших сообщений: {e}")
@@ -1,16 +1,47 @@
 import peewee
 import telegram
+import asyncio
 import datetime
 import logging
+import random
 import sys
+import time
 from telegram import Update
-from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters, CommandHandler
-from db_init import initialize_database, check_database_connection
-from db_connector import (dbhandle, Messages, BannedUsers, create_message_in_db, get_message_id_from_db,
-                          set_last_reply_time, set_new_banned_user, remove_message_from_db,
-                          get_banned_users,
-                          is_not_to_many_messages_in_period, get_chat_id_by_full_name_and_date)
-from settings import ADMIN_CHAT_ID, BAN_MESSAGE, MESSAGE_IS_RECEIVED_BY_ADMIN, START_MESSAGE, BOT_TOKEN
+from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters, CommandHandler, TypeHandler
+from db_init import prepare_database
+from db_async import (create_message_in_db, get_message_id_from_db,
+                      set_last_reply_time, remove_message_from_db,
+                      get_chat_id_by_full_name_and_date, claim_admin_reply, release_admin_reply,
+                      run_in_db_executor, shutdown_db_executor)
+import db_connector
+from db_connector import start_message_buffer, get_pool_stats
+from ban_cache import (load_banned_users, is_user_banned, ban_user, unban_user, refresh_ban_cache,
+                       start_ban_events_sync, sync_ban_events)
+from shared_state import shared_store, cleanup_shared_state
+from replicas import UpdatePartitioner, RoutingUpdateQueue
+from profiler import UpdateProfiler, save_profile
+from rate_limiter import is_not_to_many_messages_in_period
+from forward_map import ForwardTarget, remember_forward, resolve_forward
+from update_processor import ChatOrderedUpdateProcessor, get_ordering_key
+from outbound import OutboundDispatcher, PRIORITY_HIGH, PRIORITY_LOW
+from media_group import MediaGroupCollector, get_input_media
+from retention import run_retention
+from metrics import timed_handler, register_gauge, metrics_endpoint, duplicate_updates, handler_errors
+from http_server import start_http_server
+from health import HealthMonitor
+from dedup import UpdateDeduplicator
+from broadcast import BroadcastManager
+from settings import (ADMIN_CHAT_ID, BAN_MESSAGE, UNBAN_MESSAGE, MESSAGE_IS_RECEIVED_BY_ADMIN, START_MESSAGE,
+                      BOT_TOKEN, BAN_CACHE_REFRESH_INTERVAL, UPDATE_MODE, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+                      WEBHOOK_URL, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, UPDATE_CONCURRENCY,
+                      UPDATE_MAX_PENDING, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE_PER_MINUTE,
+                      OUTBOUND_ADMIN_CHAT_RATE_PER_MINUTE, OUTBOUND_ADMIN_CHAT_BURST, OUTBOUND_CHAT_BURST,
+                      OUTBOUND_MAX_QUEUE_SIZE, OUTBOUND_MAX_RETRIES, MEDIA_GROUP_WAIT_MS, RETENTION_IN_BOT,
+                      RETENTION_INTERVAL, MESSAGES_PARTITIONING, METRICS_LISTEN, METRICS_PORT,
+                      SHARED_STORE_POLL_INTERVAL, REPLICA_PEERS, REPLICA_INDEX, REPLICA_FORWARD_TIMEOUT, PROFILE_DIR,
+                      PROFILE_TOP_FUNCTIONS, PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SECONDS, HEALTH_PORT, HEALTH_LISTEN,
+                      HEALTH_MAX_LOOP_LAG, HEALTH_DB_TIMEOUT, DEDUP_CACHE_SIZE, BROADCAST_CONCURRENCY,
+                      BROADCAST_PAGE_SIZE)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,8 +50,20 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Момент запуска процесса, от него считается время старта бота
+started_at = time.monotonic()
 
-def get_origin_message_chat_id(forward_origin_message):
+media_groups = MediaGroupCollector(MEDIA_GROUP_WAIT_MS / 1000)
+http_servers = []
+health = HealthMonitor(HEALTH_MAX_LOOP_LAG, HEALTH_DB_TIMEOUT)
+deduplicator = UpdateDeduplicator(DEDUP_CACHE_SIZE) if DEDUP_CACHE_SIZE > 0 else None
+broadcasts = BroadcastManager(ADMIN_CHAT_ID, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE, REPLICA_INDEX)
+profiler = UpdateProfiler(PROFILE_TOP_FUNCTIONS)
+partitioner = (UpdatePartitioner(REPLICA_PEERS, REPLICA_INDEX, WEBHOOK_SECRET_TOKEN, REPLICA_FORWARD_TIMEOUT)
+               if REPLICA_PEERS else None)
+
+
+async def get_origin_message_chat_id(forward_origin_message):
     """Получает ID чата из forward_origin сообщения"""
     try:
         if forward_origin_message['type'] == telegram.constants.MessageOriginType.USER:
@@ -28,7 +71,7 @@ def get_origin_message_chat_id(forward_origin_message):
         if forward_origin_message['type'] == telegram.constants.MessageOriginType.HIDDEN_USER:
             user_full_name = forward_origin_message['sender_user_name']
             date_of_sending = forward_origin_message['date']
-            return get_chat_id_by_full_name_and_date(user_full_name, date_of_sending)
+            return await get_chat_id_by_full_name_and_date(user_full_name, date_of_sending)
     except KeyError as e:
         logger.error(f"Ошибка при получении chat_id из forward_origin: {e}")
         return None
@@ -69,6 +112,76 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при отправке приветственного сообщения: {e}")
 
 
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда админов /broadcast в ответ на сообщение: копирует его всем пользователям"""
+    reply_to_message = update.message.reply_to_message
+    if reply_to_message is None:
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID,
+                                       text="Отправьте /broadcast в ответ на сообщение для рассылки")
+        return
+    try:
+        broadcast_id = await broadcasts.start(context.bot, ADMIN_CHAT_ID, reply_to_message.message_id)
+    except Exception as e:
+        logger.error(f"Не удалось начать рассылку: {e}")
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"Не удалось начать рассылку: {e}")
+        return
+    logger.info(f"Админ {update.message.from_user.id} начал рассылку #{broadcast_id}")
+    await context.bot.send_message(chat_id=ADMIN_CHAT_ID,
+                                   text=f"Рассылка #{broadcast_id} начата, отчет придет по завершении")
+
+
+async def broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда админов /broadcast_stop: останавливает активные рассылки"""
+    if not broadcasts.cancel_all():
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="Активных рассылок нет")
+
+
+async def profile_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда админов /profile_start [N] [Ts] [file]: профилирование следующих N обновлений"""
+    max_updates, max_seconds, to_file = PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SECONDS, False
+    for arg in context.args:
+        if arg.isdigit():
+            max_updates = int(arg)
+        elif arg.endswith('s') and arg[:-1].isdigit():
+            max_seconds = int(arg[:-1])
+        elif arg == 'file':
+            to_file = True
+        else:
+            await context.bot.send_message(chat_id=ADMIN_CHAT_ID,
+                                           text="Использование: /profile_start [обновлений] [секунды]s [file]")
+            return
+
+    async def send_report(report, profile):
+        try:
+            if to_file:
+                path = save_profile(profile, PROFILE_DIR)
+                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"Профиль сохранен в {path}")
+            else:
+                await context.bot.send_document(chat_id=ADMIN_CHAT_ID, document=report.encode('utf-8'),
+                                                filename='profile.txt', caption=report.split('\n', 1)[0])
+        except Exception as e:
+            logger.error(f"Не удалось отправить результат профилирования: {e}")
+
+    try:
+        profiler.start(context.application.update_processor, max_updates, max_seconds, send_report)
+    except (RuntimeError, ValueError) as e:
+        # ValueError: профилировщик уже используется в процессе другим инструментом
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"Профилирование не запущено: {e}")
+        return
+    await context.bot.send_message(
+        chat_id=ADMIN_CHAT_ID,
+        text=f"Профилирование запущено: {max_updates} обновлений, не дольше {max_seconds} сек"
+    )
+
+
+async def profile_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда админов /profile_stop: досрочно завершает профилирование и отправляет отчет"""
+    if not profiler.active:
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="Профилирование не запущено")
+        return
+    profiler.stop()
+
+
 async def forward_message_to_admin_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Основной обработчик сообщений - пересылает сообщения между пользователями и админами"""
     try:
@@ -79,6 +192,7 @@ async def forward_message_to_admin_group(update: Update, context: ContextTypes.D
             # Обработка сообщений от пользователей
             await handle_user_message(update, context)
     except Exception as e:
+        handler_errors.inc('forward_message_to_admin_group')
         logger.error(f"Общая ошибка в forward_message_to_admin_group: {e}")
         try:
             await context.bot.send_message(
@@ -89,10 +203,27 @@ async def forward_message_to_admin_group(update: Update, context: ContextTypes.D
             logger.error(f"Не удалось отправить сообщение об ошибке: {send_error}")
 
 
+@timed_handler('handle_admin_message')
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка сообщений от администраторов"""
+    if update.message.media_group_id:
+        # Альбом отправляем пользователю целиком после получения всех частей
+        media_groups.add(update.message, lambda messages: process_admin_messages(messages, context),
+                         get_ordering_key(update))
+        return
+    # Альбомы админов собираются по адресату ответа: дообрабатываем только альбомы той же очереди
+    await media_groups.flush_key(get_ordering_key(update))
+    await process_admin_messages([update.message], context)
+
+
+@timed_handler('process_admin_messages')
+async def process_admin_messages(messages, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка сообщения или альбома от администраторов"""
+    message = messages[0]
+    reply_to_message = next((m.reply_to_message for m in messages if m.reply_to_message), None)
+
     # Проверяем, что сообщение является ответом на пересланное сообщение
-    if not update.message.reply_to_message:
+    if not reply_to_message:
         logger.warning("Админ отправил сообщение не в ответ на пересланное сообщение")
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID,
@@ -100,20 +231,34 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
 
-    # Проверяем, что reply_to_message имеет forward_origin
-    if not hasattr(update.message.reply_to_message, 'forward_origin') or not update.message.reply_to_message.forward_origin:
-        logger.warning("Сообщение не содержит информации о пересылке")
-        await context.bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
-            text="Это сообщение не является пересланным от пользователя"
-        )
+    # Повторная доставка после перезапуска не должна отправить ответ пользователю еще раз
+    try:
+        claimed = await claim_admin_reply(message.message_id, int(message.date.timestamp()))
+    except Exception as e:
+        # Недоступность БД не должна блокировать ответы: обрабатываем без отметки
+        logger.warning(f"Не удалось отметить сообщение админа {message.message_id} обработанным: {e}")
+        claimed = True
+    if not claimed:
+        duplicate_updates.inc('database')
+        logger.info(f"Сообщение админа {message.message_id} уже обработано, повторная доставка пропущена")
         return
 
     try:
-        forward_origin_message = update.message.reply_to_message.forward_origin.to_dict()
-        origin_message_chat_id = get_origin_message_chat_id(forward_origin_message)
-        
-        if not origin_message_chat_id:
+        # Ищем получателя по ID пересланного сообщения в чате админов
+        target = await resolve_forward(reply_to_message.message_id)
+
+        if target is None:
+            # Сообщения, пересланные до появления таблицы соответствий, разбираем по forward_origin
+            if not reply_to_message.forward_origin:
+                logger.warning("Сообщение не содержит информации о пересылке")
+                await context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text="Это сообщение не является пересланным от пользователя"
+                )
+                return
+            target = await get_target_by_origin_message(reply_to_message.forward_origin.to_dict())
+
+        if not target:
             logger.error("Не удалось определить chat_id отправителя")
             await context.bot.send_message(
                 chat_id=ADMIN_CHAT_ID,
@@ -122,37 +267,61 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             return
 
         # Обработка команды бана
-        if update.message.text == BAN_MESSAGE:
-            await handle_ban_command(update, context, forward_origin_message, origin_message_chat_id)
+        if message.text == BAN_MESSAGE:
+            await handle_ban_command(message, context, target)
+        elif message.text == UNBAN_MESSAGE:
+            await handle_unban_command(context, target)
         else:
             # Отправка ответа пользователю
-            await send_reply_to_user(update, context, forward_origin_message, origin_message_chat_id)
+            await send_reply_to_user(messages, context, target)
             
     except Exception as e:
+        handler_errors.inc('process_admin_messages')
         logger.error(f"Ошибка при обработке сообщения от админа: {e}")
+        try:
+            # Ответ не отправлен: повторная доставка должна обработать сообщение снова
+            await release_admin_reply(message.message_id)
+        except Exception as release_error:
+            logger.error(f"Не удалось снять отметку обработки сообщения админа: {release_error}")
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID,
             text=f"Ошибка при обработке сообщения: {str(e)}"
         )
 
 
-async def handle_ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                           forward_origin_message: dict, origin_message_chat_id: int):
+async def get_target_by_origin_message(forward_origin_message):
+    """Определяет получателя ответа по forward_origin пересланного сообщения"""
+    origin_message_chat_id = await get_origin_message_chat_id(forward_origin_message)
+    if not origin_message_chat_id:
+        return None
+
+    origin_message_timestamp = forward_origin_message['date']
+    # Получаем ID оригинального сообщения из БД
+    original_message_id = await get_message_id_from_db(origin_message_chat_id, origin_message_timestamp)
+    return ForwardTarget(
+        user_id=origin_message_chat_id,
+        message_id=original_message_id,
+        message_date=origin_message_timestamp,
+        user_full_name=get_user_full_name_by_origin_message(forward_origin_message),
+        nickname=get_user_nickname_by_origin_message(forward_origin_message)
+    )
+
+
+@timed_handler('handle_ban_command')
+async def handle_ban_command(message, context: ContextTypes.DEFAULT_TYPE, target: ForwardTarget):
     """Обработка команды бана пользователя"""
     try:
-        origin_message_user_nickname = get_user_nickname_by_origin_message(forward_origin_message)
-        origin_message_user_full_name = get_user_full_name_by_origin_message(forward_origin_message)
-        
-        set_new_banned_user(origin_message_chat_id, origin_message_user_nickname, origin_message_user_full_name)
-        remove_message_from_db(update.message.from_user.id)
+        await ban_user(target.user_id, target.nickname, target.user_full_name)
+        await remove_message_from_db(message.from_user.id)
         
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID,
-            text=f"Пользователь {origin_message_user_full_name} (ID: {origin_message_chat_id}) заблокирован"
+            text=f"Пользователь {target.user_full_name} (ID: {target.user_id}) заблокирован"
         )
-        logger.info(f"Пользователь {origin_message_chat_id} заблокирован")
+        logger.info(f"Пользователь {target.user_id} заблокирован")
         
     except Exception as e:
+        handler_errors.inc('handle_ban_command')
         logger.error(f"Ошибка при блокировке пользователя: {e}")
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID,
@@ -160,33 +329,51 @@ async def handle_ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
 
 
-async def send_reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                           forward_origin_message: dict, origin_message_chat_id: int):
-    """Отправка ответа пользователю"""
+@timed_handler('handle_unban_command')
+async def handle_unban_command(context: ContextTypes.DEFAULT_TYPE, target: ForwardTarget):
+    """Обработка команды снятия бана пользователя"""
     try:
-        origin_message_timestamp = forward_origin_message['date']
+        await unban_user(target.user_id)
         
-        # Получаем ID оригинального сообщения из БД
-        original_message_id = get_message_id_from_db(origin_message_chat_id, origin_message_timestamp)
+        await context.bot.send_message(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"Пользователь {target.user_full_name} (ID: {target.user_id}) разблокирован"
+        )
+        logger.info(f"Пользователь {target.user_id} разблокирован")
         
+    except Exception as e:
+        handler_errors.inc('handle_unban_command')
+        logger.error(f"Ошибка при разблокировке пользователя: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_CHAT_ID,
+            text=f"Ошибка при разблокировке пользователя: {str(e)}"
+        )
+
+
+async def send_reply_to_user(messages, context: ContextTypes.DEFAULT_TYPE, target: ForwardTarget):
+    """Отправка ответа пользователю"""
+    try:
         reply_parameters = None
-        if original_message_id:
+        if target.message_id:
             reply_parameters = telegram.ReplyParameters(
-                message_id=original_message_id,
-                chat_id=origin_message_chat_id
+                message_id=target.message_id,
+                chat_id=target.user_id
             )
 
-        # Отправляем соответствующий тип сообщения
-        success = await send_message_by_type(update, context, origin_message_chat_id, reply_parameters)
+        # Отправляем соответствующий тип сообщения или альбом целиком
+        if len(messages) > 1:
+            success = await send_media_group(messages, context, target.user_id, reply_parameters)
+        else:
+            success = await send_message_by_type(messages[0], context, target.user_id, reply_parameters)
         
         if success:
             # Обновляем время последнего ответа
-            set_last_reply_time(
-                user_id=origin_message_chat_id, 
-                message_date=origin_message_timestamp,
+            await set_last_reply_time(
+                user_id=target.user_id, 
+                message_date=target.message_date,
                 last_reply_time=datetime.datetime.now().timestamp()
             )
-            logger.info(f"Ответ отправлен пользователю {origin_message_chat_id}")
+            logger.info(f"Ответ отправлен пользователю {target.user_id}")
         else:
             await context.bot.send_message(
                 chat_id=ADMIN_CHAT_ID, 
@@ -201,45 +388,48 @@ async def send_reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
 
 
-async def send_message_by_type(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                              chat_id: int, reply_parameters) -> bool:
+async def send_message_by_type(message, context: ContextTypes.DEFAULT_TYPE,
+                               chat_id: int, reply_parameters) -> bool:
     """Отправляет сообщение соответствующего типа"""
     try:
-        message = update.message
-        
         if message.text is not None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text=message.text,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.document is not None:
             await context.bot.send_document(
                 chat_id=chat_id,
                 document=message.document.file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.audio is not None:
             await context.bot.send_audio(
                 chat_id=chat_id,
                 audio=message.audio.file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.video is not None:
             await context.bot.send_video(
                 chat_id=chat_id,
                 video=message.video.file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.animation is not None:
             await context.bot.send_animation(
                 chat_id=chat_id,
                 animation=message.animation.file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.photo and len(message.photo) > 0:
             # Берем фото с наибольшим разрешением (последнее в списке)
@@ -247,20 +437,23 @@ async def send_message_by_type(update: Update, context: ContextTypes.DEFAULT_TYP
                 chat_id=chat_id,
                 photo=message.photo[-1].file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.sticker is not None:
             await context.bot.send_sticker(
                 chat_id=chat_id,
                 sticker=message.sticker.file_id,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         elif message.voice is not None:
             await context.bot.send_voice(
                 chat_id=chat_id,
                 voice=message.voice.file_id,
                 caption=message.caption,
-                reply_parameters=reply_parameters
+                reply_parameters=reply_parameters,
+                rate_limit_args=PRIORITY_HIGH
             )
         else:
             return False  # Неподдерживаемый тип сообщения
@@ -268,54 +461,118 @@ async def send_message_by_type(update: Update, context: ContextTypes.DEFAULT_TYP
         return True
         
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения типа {type(update.message)}: {e}")
+        logger.error(f"Ошибка при отправке сообщения типа {type(message)}: {e}")
+        return False
+
+
+async def send_media_group(messages, context: ContextTypes.DEFAULT_TYPE,
+                           chat_id: int, reply_parameters) -> bool:
+    """Отправляет альбом одним вызовом send_media_group"""
+    try:
+        media = [get_input_media(message) for message in messages]
+        if None in media:
+            return False  # В альбоме есть неподдерживаемый тип сообщения
+
+        await context.bot.send_media_group(
+            chat_id=chat_id,
+            media=media,
+            reply_parameters=reply_parameters,
+            rate_limit_args=PRIORITY_HIGH
+        )
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка при отправке альбома из {len(messages)} сообщений: {e}")
         return False
 
 
+@timed_handler('handle_user_message')
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка сообщений от пользователей"""
+    if update.message.media_group_id:
+        # Части альбома пересылаем админам одним пакетом
+        media_groups.add(update.message, lambda messages: process_user_messages(messages, context),
+                         get_ordering_key(update))
+        return
+    # Сначала дообрабатываем альбомы этого чата, чтобы не нарушить порядок сообщений
+    await media_groups.flush_key(get_ordering_key(update))
+    await process_user_messages([update.message], context)
+
+
+@timed_handler('process_user_messages')
+async def process_user_messages(messages, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка сообщения или альбома от пользователя"""
+    message = messages[0]
     try:
-        user_id = update.message.from_user.id
+        user_id = message.from_user.id
         
         # Проверяем, не заблокирован ли пользователь
-        if user_id in get_banned_users():
+        if await is_user_banned(user_id):
             await context.bot.send_message(
-                chat_id=update.message.chat_id, 
-                text=MESSAGE_IS_RECEIVED_BY_ADMIN
+                chat_id=message.chat_id, 
+                text=MESSAGE_IS_RECEIVED_BY_ADMIN,
+                rate_limit_args=PRIORITY_LOW
             )
             logger.info(f"Заблокированный пользователь {user_id} попытался отправить сообщение")
             return
 
         # Проверяем лимит сообщений
-        if not is_not_to_many_messages_in_period(user_id):
+        if not await is_not_to_many_messages_in_period(user_id):
             await context.bot.send_message(
-                chat_id=update.message.chat_id,
+                chat_id=message.chat_id,
                 text='Слишком много сообщений, попробуйте позже'
             )
             logger.warning(f"Пользователь {user_id} превысил лимит сообщений")
             return
 
-        # Сохраняем сообщение в БД и пересылаем админам
-        create_message_in_db(
+        # Сохраняем сообщение в БД и пересылаем админам (альбом — одной записью и одним вызовом)
+        if not await create_message_in_db(
             user_id, 
-            update.message.from_user.full_name,
-            update.message.date.timestamp(), 
-            update.message.message_id
-        )
+            message.from_user.full_name,
+            message.date.timestamp(), 
+            message.message_id
+        ):
+            # Повторная доставка после перезапуска: сообщение уже сохранено и переслано
+            duplicate_updates.inc('database')
+            logger.info(f"Сообщение {message.message_id} пользователя {user_id} уже обработано, повтор пропущен")
+            return
         
-        await update.message.forward(chat_id=ADMIN_CHAT_ID)
+        if len(messages) > 1:
+            forwarded_messages = await context.bot.forward_messages(
+                chat_id=ADMIN_CHAT_ID,
+                from_chat_id=message.chat_id,
+                message_ids=[m.message_id for m in messages]
+            )
+        else:
+            forwarded_messages = [await message.forward(chat_id=ADMIN_CHAT_ID)]
+
+        target = ForwardTarget(
+            user_id=user_id,
+            message_id=message.message_id,
+            message_date=int(message.date.timestamp()),
+            user_full_name=message.from_user.full_name,
+            nickname=message.from_user.username
+        )
+        try:
+            for forwarded_message in forwarded_messages:
+                await remember_forward(forwarded_message.message_id, target)
+        except Exception as e:
+            # Ответ на такое сообщение будет разобран по forward_origin
+            logger.error(f"Не удалось сохранить соответствие пересланного сообщения: {e}")
         await context.bot.send_message(
-            chat_id=update.message.chat_id, 
-            text=MESSAGE_IS_RECEIVED_BY_ADMIN
+            chat_id=message.chat_id, 
+            text=MESSAGE_IS_RECEIVED_BY_ADMIN,
+            rate_limit_args=PRIORITY_LOW
         )
         
         logger.info(f"Сообщение от пользователя {user_id} переслано админам")
         
     except Exception as e:
+        handler_errors.inc('process_user_messages')
         logger.error(f"Ошибка при обработке сообщения пользователя: {e}")
         try:
             await context.bot.send_message(
-                chat_id=update.message.chat_id,
+                chat_id=message.chat_id,
                 text="Произошла ошибка при обработке вашего сообщения. Попробуйте позже."
             )
         except Exception as send_error:
@@ -336,61 +593,183 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
 
 
-def init_database_with_retries(max_retries=3, delay=2):
-    """Инициализация базы данных с повторными попытками"""
-    import time
-    
+def register_queue_gauges(application):
+    """Регистрирует показатели очередей и пула соединений"""
+    dispatcher = application.bot.rate_limiter
+    register_gauge('bot_outbound_queue_depth', 'Запросов в очереди исходящих сообщений',
+                   lambda: dispatcher.stats()['queue_depth'])
+    register_gauge('bot_media_groups_pending', 'Альбомов в ожидании остальных частей', lambda: len(media_groups))
+    register_gauge('bot_broadcasts_active', 'Активных рассылок', lambda: len(broadcasts))
+    if deduplicator is not None:
+        register_gauge('bot_dedup_cache_keys', 'Ключей в кэше повторных доставок', lambda: len(deduplicator))
+    register_gauge('bot_write_buffer_rows', 'Сообщений в буфере отложенной записи',
+                   lambda: len(db_connector.message_buffer) if db_connector.message_buffer is not None else 0)
+    for key in ('in_use', 'idle', 'created', 'recycled', 'checkouts', 'wait_time_max'):
+        register_gauge(f'bot_db_pool_{key}', f'Пул соединений с БД: {key}',
+                       lambda name=key: get_pool_stats()[name])
+
+
+def get_http_routes():
+    """Служебные пути по портам: метрики и проверки здоровья могут делить один порт"""
+    servers = {}
+    if HEALTH_PORT > 0:
+        host, routes = servers.setdefault(HEALTH_PORT, (HEALTH_LISTEN, {}))
+        routes.update({'/healthz': health.liveness, '/readyz': health.readiness})
+    if METRICS_PORT > 0:
+        host, routes = servers.setdefault(METRICS_PORT, (METRICS_LISTEN, {}))
+        routes['/metrics'] = metrics_endpoint
+    return servers
+
+
+async def on_startup(application):
+    """Подготовка базы данных и кэшей после инициализации бота"""
+    # Проверка живости отвечает уже во время подготовки базы, готовность — после нее
+    health.start(application.update_processor)
+    media_groups.update_processor = application.update_processor
+    if METRICS_PORT > 0:
+        register_queue_gauges(application)
+    for port, (host, routes) in get_http_routes().items():
+        http_servers.append(await start_http_server(host, port, routes))
+    db_started = time.monotonic()
+    if not await init_database_with_retries():
+        raise RuntimeError("Не удалось подготовить базу данных")
+    db_elapsed = time.monotonic() - db_started
+    start_message_buffer()
+    if shared_store is not None:
+        await start_ban_events_sync()
+        application.job_queue.run_repeating(sync_ban_events, interval=SHARED_STORE_POLL_INTERVAL,
+                                            first=SHARED_STORE_POLL_INTERVAL)
+        application.job_queue.run_repeating(cleanup_shared_state, interval=600, first=600)
+    else:
+        await load_banned_users()
+    if BAN_CACHE_REFRESH_INTERVAL > 0:
+        application.job_queue.run_repeating(refresh_ban_cache, interval=BAN_CACHE_REFRESH_INTERVAL,
+                                            first=BAN_CACHE_REFRESH_INTERVAL)
+    if RETENTION_IN_BOT and MESSAGES_PARTITIONING != 'none':
+        logger.warning("Очистка внутри бота не используется с секционированием messages, "
+                       "секции удаляет message_cleaner")
+    elif RETENTION_IN_BOT and REPLICA_INDEX != 0:
+        logger.info("Очистку устаревших сообщений выполняет реплика #0")
+    elif RETENTION_IN_BOT:
+        # Очистка по расписанию внутри бота вместо отдельного сервиса message_cleaner
+        application.job_queue.run_repeating(run_retention, interval=RETENTION_INTERVAL, first=60)
+        logger.info(f"Очистка устаревших сообщений запускается каждые {RETENTION_INTERVAL} сек")
+    await broadcasts.resume(application.bot)
+    health.ready = True
+    logger.info(f"Бот готов к работе за {time.monotonic() - started_at:.2f} сек "
+                f"(подготовка базы данных: {db_elapsed:.2f} сек)")
+
+
+async def on_stop(application):
+    """Дообрабатывает собранные альбомы перед остановкой бота"""
+    health.ready = False
+    if profiler.active:
+        profiler.stop()
+    await broadcasts.stop()
+    await media_groups.flush_all()
+
+
+async def on_shutdown(application):
+    """Освобождает ресурсы при остановке бота"""
+    for server in http_servers:
+        server.close()
+        await server.wait_closed()
+    await health.stop()
+    if partitioner is not None:
+        await partitioner.close()
+    shutdown_db_executor()
+
+
+def run_application(application):
+    """Запускает получение обновлений в выбранном режиме"""
+    if partitioner is not None and UPDATE_MODE != 'webhook':
+        raise ValueError("Несколько реплик (REPLICA_PEERS) работают только в режиме UPDATE_MODE=webhook")
+    if UPDATE_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            # Иначе python-telegram-bot зарегистрирует в setWebhook адрес вида http://0.0.0.0:8443/...
+            raise ValueError("В режиме UPDATE_MODE=webhook необходимо задать публичный адрес WEBHOOK_URL")
+        logger.info(f"Режим webhook: прием обновлений на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    elif UPDATE_MODE == 'polling':
+        application.run_polling()
+    else:
+        raise ValueError(f"Неизвестный режим получения обновлений: {UPDATE_MODE}")
+
+
+async def init_database_with_retries(max_retries=3, delay=2):
+    """Подготовка базы данных с повторными попытками, не блокирующая цикл событий"""
     for attempt in range(max_retries):
         try:
-            logger.info(f"Попытка инициализации базы данных #{attempt + 1}")
-            
-            # Инициализируем базу данных
-            if initialize_database():
-                logger.info("База данных успешно инициализирована")
-                
-                # Проверяем подключение (необязательно для работы)
-                if check_database_connection():
-                    logger.info("Проверка подключения прошла успешно")
-                else:
-                    logger.warning("Проверка подключения не удалась, но база данных инициализирована")
-                
+            logger.info(f"Попытка подготовки базы данных #{attempt + 1}")
+            if await run_in_db_executor(prepare_database):
                 return True
-            else:
-                logger.warning("Не удалось инициализировать базу данных")
-                
+            logger.warning("Не удалось подготовить базу данных")
         except Exception as e:
-            logger.error(f"Ошибка при инициализации базы данных (попытка {attempt + 1}): {e}")
+            logger.error(f"Ошибка при подготовке базы данных (попытка {attempt + 1}): {e}")
         
         if attempt < max_retries - 1:
-            logger.info(f"Ожидание {delay} секунд перед следующей попыткой...")
-            time.sleep(delay)
-            delay *= 2  # Экспоненциальное увеличение задержки
+            # Случайный разброс, чтобы реплики не повторяли попытки одновременно
+            wait = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.info(f"Ожидание {wait:.1f} секунд перед следующей попыткой...")
+            await asyncio.sleep(wait)
     
-    logger.error("Не удалось инициализировать базу данных после всех попыток")
+    logger.error("Не удалось подготовить базу данных после всех попыток")
     return False
 
 
 if __name__ == '__main__':
     logger.info("Запуск Telegram бота поддержки...")
     
-    # Инициализация базы данных с повторными попытками
-    if not init_database_with_retries():
-        logger.critical("Критическая ошибка: Не удалось инициализировать базу данных. Завершение работы.")
-        sys.exit(1)
-    
+    # База данных готовится в on_startup, уже внутри цикла событий
     try:
         # Создание и настройка приложения
-        application = ApplicationBuilder().token(BOT_TOKEN).build()
+        builder = (ApplicationBuilder()
+                   .token(BOT_TOKEN)
+                   .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING))
+                   .rate_limiter(OutboundDispatcher(
+                       global_rate=OUTBOUND_GLOBAL_RATE,
+                       chat_rate=OUTBOUND_CHAT_RATE,
+                       group_rate_per_minute=OUTBOUND_GROUP_RATE_PER_MINUTE,
+                       burst=OUTBOUND_CHAT_BURST,
+                       max_queue_size=OUTBOUND_MAX_QUEUE_SIZE,
+                       max_retries=OUTBOUND_MAX_RETRIES,
+                       admin_chat_id=ADMIN_CHAT_ID,
+                       admin_chat_rate_per_minute=OUTBOUND_ADMIN_CHAT_RATE_PER_MINUTE,
+                       admin_chat_burst=OUTBOUND_ADMIN_CHAT_BURST
+                   ))
+                   .post_init(on_startup)
+                   .post_stop(on_stop)
+                   .post_shutdown(on_shutdown))
+        if partitioner is not None:
+            # Чужие обновления передаются реплике-владельцу при получении, до очереди приложения
+            builder.update_queue(RoutingUpdateQueue(partitioner))
+            logger.info(f"Реплика #{REPLICA_INDEX} из {len(REPLICA_PEERS)}")
+        application = builder.build()
         
         # Добавление обработчиков
+        if deduplicator is not None:
+            # Повторно доставленные обновления отбрасываются раньше всех остальных обработчиков
+            application.add_handler(TypeHandler(Update, deduplicator.drop_duplicates), group=-2)
         application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, forward_message_to_admin_group))
         application.add_handler(CommandHandler('start', start))
+        application.add_handler(CommandHandler('profile_start', profile_start, filters=filters.Chat(ADMIN_CHAT_ID)))
+        application.add_handler(CommandHandler('profile_stop', profile_stop, filters=filters.Chat(ADMIN_CHAT_ID)))
+        application.add_handler(CommandHandler('broadcast', broadcast, filters=filters.Chat(ADMIN_CHAT_ID)))
+        application.add_handler(CommandHandler('broadcast_stop', broadcast_stop,
+                                               filters=filters.Chat(ADMIN_CHAT_ID)))
         
         # Добавление глобального обработчика ошибок
         application.add_error_handler(error_handler)
         
         logger.info("Бот запущен и готов к работе")
-        application.run_polling()
+        run_application(application)
         
     except KeyboardInterrupt:
         logger.info("Получен сигнал прерывания. Завершение работы...")
@@ -3,6 +3,7 @@ from os import environ
 BOT_TOKEN = environ.get('BOT_TOKEN')
 ADMIN_CHAT_ID = int(environ.get('ADMIN_CHAT_ID'))
 BAN_MESSAGE = environ.get('BAN_MESSAGE', 'Бан+1')
+UNBAN_MESSAGE = environ.get('UNBAN_MESSAGE', 'Разбан')
 MESSAGE_COUNT_PERIOD = int(environ.get('MESSAGE_COUNT_PERIOD', 60))
 MESSAGE_IS_RECEIVED_BY_ADMIN = environ.get('MESSAGE_IS_RECEIVED_BY_ADMIN',
                                            'Ваше обращение успешно отправлено. Вам ответят в ближайшее время')
@@ -12,3 +13,60 @@ DB_USER = environ.get('DB_USER')
 DB_PASSWORD = environ.get('DB_PASSWORD')
 DB_NAME = environ.get('DB_NAME')
 DB_HOST = environ.get('DB_HOST')
+DB_BACKEND = environ.get('DB_BACKEND', 'mysql')
+DB_SQLITE_PATH = environ.get('DB_SQLITE_PATH', 'support_bot.db')
+DB_EXECUTOR_WORKERS = int(environ.get('DB_EXECUTOR_WORKERS', 4))
+DB_POOL_MAX_CONNECTIONS = int(environ.get('DB_POOL_MAX_CONNECTIONS', 8))
+DB_POOL_WAIT_TIMEOUT = int(environ.get('DB_POOL_WAIT_TIMEOUT', 10))
+DB_POOL_IDLE_TIMEOUT = int(environ.get('DB_POOL_IDLE_TIMEOUT', 60))
+DB_POOL_STALE_TIMEOUT = int(environ.get('DB_POOL_STALE_TIMEOUT', 300))
+BAN_CACHE_REFRESH_INTERVAL = int(environ.get('BAN_CACHE_REFRESH_INTERVAL', 0))
+RATE_LIMITER_MAX_USERS = int(environ.get('RATE_LIMITER_MAX_USERS', 10000))
+FORWARD_MAP_CACHE_SIZE = int(environ.get('FORWARD_MAP_CACHE_SIZE', 10000))
+UPDATE_MODE = environ.get('UPDATE_MODE', 'polling')
+WEBHOOK_LISTEN = environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET_TOKEN = environ.get('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+UPDATE_CONCURRENCY = int(environ.get('UPDATE_CONCURRENCY', 16))
+UPDATE_MAX_PENDING = int(environ.get('UPDATE_MAX_PENDING', 256))
+DEDUP_CACHE_SIZE = int(environ.get('DEDUP_CACHE_SIZE', 10000))
+OUTBOUND_GLOBAL_RATE = float(environ.get('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(environ.get('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_GROUP_RATE_PER_MINUTE = float(environ.get('OUTBOUND_GROUP_RATE_PER_MINUTE', 20))
+OUTBOUND_ADMIN_CHAT_RATE_PER_MINUTE = float(environ.get('OUTBOUND_ADMIN_CHAT_RATE_PER_MINUTE', 20))
+OUTBOUND_ADMIN_CHAT_BURST = int(environ.get('OUTBOUND_ADMIN_CHAT_BURST', 10))
+OUTBOUND_CHAT_BURST = int(environ.get('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_MAX_QUEUE_SIZE = int(environ.get('OUTBOUND_MAX_QUEUE_SIZE', 1000))
+OUTBOUND_MAX_RETRIES = int(environ.get('OUTBOUND_MAX_RETRIES', 3))
+WRITE_BEHIND_ENABLED = environ.get('WRITE_BEHIND_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+WRITE_BEHIND_MAX_ROWS = int(environ.get('WRITE_BEHIND_MAX_ROWS', 100))
+WRITE_BEHIND_MAX_DELAY_MS = int(environ.get('WRITE_BEHIND_MAX_DELAY_MS', 200))
+WRITE_BEHIND_MAX_PENDING = int(environ.get('WRITE_BEHIND_MAX_PENDING', 10000))
+MEDIA_GROUP_WAIT_MS = int(environ.get('MEDIA_GROUP_WAIT_MS', 700))
+MESSAGES_PARTITIONING = environ.get('MESSAGES_PARTITIONING', 'none')
+MESSAGES_PARTITIONS_AHEAD = int(environ.get('MESSAGES_PARTITIONS_AHEAD', 7))
+MESSAGES_TO_DELETE_HOURS = int(environ.get('MESSAGES_TO_DELETE_HOURS', 72))
+RETENTION_IN_BOT = environ.get('RETENTION_IN_BOT', 'false').lower() in ('1', 'true', 'yes')
+RETENTION_INTERVAL = int(environ.get('RETENTION_INTERVAL', 3600))
+RETENTION_BATCH_SIZE = int(environ.get('RETENTION_BATCH_SIZE', 500))
+RETENTION_BATCH_PAUSE_MS = int(environ.get('RETENTION_BATCH_PAUSE_MS', 100))
+METRICS_PORT = int(environ.get('METRICS_PORT', 0))
+METRICS_LISTEN = environ.get('METRICS_LISTEN', '0.0.0.0')
+HEALTH_PORT = int(environ.get('HEALTH_PORT', 8080))
+HEALTH_LISTEN = environ.get('HEALTH_LISTEN', '0.0.0.0')
+HEALTH_MAX_LOOP_LAG = float(environ.get('HEALTH_MAX_LOOP_LAG', 1))
+HEALTH_DB_TIMEOUT = float(environ.get('HEALTH_DB_TIMEOUT', 2))
+SHARED_STORE = environ.get('SHARED_STORE', 'none')
+SHARED_STORE_POLL_INTERVAL = float(environ.get('SHARED_STORE_POLL_INTERVAL', 1))
+REPLICA_PEERS = [peer.strip() for peer in environ.get('REPLICA_PEERS', '').split(',') if peer.strip()]
+REPLICA_INDEX = int(environ.get('REPLICA_INDEX', 0))
+REPLICA_FORWARD_TIMEOUT = int(environ.get('REPLICA_FORWARD_TIMEOUT', 10))
+PROFILE_DIR = environ.get('PROFILE_DIR', 'profiles')
+PROFILE_TOP_FUNCTIONS = int(environ.get('PROFILE_TOP_FUNCTIONS', 25))
+PROFILE_DEFAULT_UPDATES = int(environ.get('PROFILE_DEFAULT_UPDATES', 100))
+PROFILE_MAX_SECONDS = int(environ.get('PROFILE_MAX_SECONDS', 60))
+BROADCAST_CONCURRENCY = int(environ.get('BROADCAST_CONCURRENCY', 10))
+BROADCAST_PAGE_SIZE = int(environ.get('BROADCAST_PAGE_SIZE', 500))
@@ -0,0 +1,99 @@
+"""
+Общее состояние нескольких реплик бота.
+Реплики обмениваются событиями банов (для сброса кэша) и счетчиками частоты сообщений
+через хранилище, выбранное настройкой SHARED_STORE: database — таблицы в общей БД,
+local — замена в памяти процесса для тестов, none — одна реплика без общего состояния.
+"""
+import logging
+import threading
+import time
+
+from db_async import (create_ban_event, get_ban_events, get_last_ban_event_id, increment_rate_counter,
+                      remove_obsolete_shared_state)
+from settings import SHARED_STORE, MESSAGE_COUNT_PERIOD
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить события банов; реплики забирают их каждые SHARED_STORE_POLL_INTERVAL секунд
+BAN_EVENTS_TTL = 86400
+
+
+class LocalSharedStore:
+    """Общее состояние в памяти процесса (для тестов и запуска нескольких реплик в одном процессе)"""
+
+    def __init__(self):
+        self._events = []
+        self._last_event_id = 0
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    async def publish_ban(self, user_id, banned):
+        with self._lock:
+            self._last_event_id += 1
+            self._events.append((self._last_event_id, user_id, banned, time.time()))
+
+    async def get_last_ban_event_id(self):
+        return self._last_event_id
+
+    async def fetch_ban_events(self, after_id):
+        with self._lock:
+            return [(event_id, user_id, banned) for event_id, user_id, banned, _ in self._events
+                    if event_id > after_id]
+
+    async def increment_rate_counter(self, user_id, window_start):
+        with self._lock:
+            key = (user_id, window_start)
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    async def remove_obsolete(self, rate_edge, events_edge):
+        with self._lock:
+            self._counters = {key: hits for key, hits in self._counters.items() if key[1] >= rate_edge}
+            self._events = [event for event in self._events if event[3] >= events_edge]
+
+
+class DatabaseSharedStore:
+    """Общее состояние в таблицах banevents и ratecounters общей БД"""
+
+    async def publish_ban(self, user_id, banned):
+        await create_ban_event(user_id, banned)
+
+    async def get_last_ban_event_id(self):
+        return await get_last_ban_event_id()
+
+    async def fetch_ban_events(self, after_id):
+        return await get_ban_events(after_id)
+
+    async def increment_rate_counter(self, user_id, window_start):
+        return await increment_rate_counter(user_id, window_start)
+
+    async def remove_obsolete(self, rate_edge, events_edge):
+        await remove_obsolete_shared_state(rate_edge, events_edge)
+
+
+SHARED_STORES = {
+    'local': LocalSharedStore,
+    'database': DatabaseSharedStore,
+}
+
+
+def create_shared_store(kind):
+    """Создает хранилище общего состояния или возвращает None для одной реплики"""
+    if kind == 'none':
+        return None
+    if kind not in SHARED_STORES:
+        raise ValueError(f"Неизвестное хранилище общего состояния SHARED_STORE={kind}")
+    logger.info(f"Общее состояние реплик хранится в {kind}")
+    return SHARED_STORES[kind]()
+
+
+shared_store = create_shared_store(SHARED_STORE)
+
+
+async def cleanup_shared_state(context):
+    """Задание очереди: удаляет закрытые окна счетчиков и старые события банов"""
+    now = time.time()
+    try:
+        await shared_store.remove_obsolete(now - 2 * MESSAGE_COUNT_PERIOD, now - BAN_EVENTS_TTL)
+    except Exception as e:
+        logger.error(f"Ошибка при очистке общего состояния реплик: {e}")
@@ -0,0 +1,34 @@
+"""
+Проверка границ секций таблицы messages.
+Запуск: cd support_bot && python -m unittest test_partitions
+"""
+import datetime
+import os
+import unittest
+
+import partitions
+
+CLEANER_PARTITIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'message_cleaner', 'partitions.py')
+
+
+class PartitionsTest(unittest.TestCase):
+
+    def test_cleaner_copy_is_identical(self):
+        with open(partitions.__file__, 'rb') as bot_copy, open(CLEANER_PARTITIONS, 'rb') as cleaner_copy:
+            self.assertEqual(bot_copy.read(), cleaner_copy.read())
+
+    def test_partitions_ahead_start_with_current_period(self):
+        now = datetime.datetime(2026, 10, 14, 15, 30, tzinfo=datetime.timezone.utc).timestamp()
+        first_start = partitions.get_partition_start(now, 'week')
+        definitions = partitions.get_partitions_ahead(first_start, now, 'week', 2)
+        self.assertEqual([definition.split()[1] for definition in definitions], ['p20261012', 'p20261019', 'p20261026'])
+        self.assertTrue(definitions[0].endswith(f"({first_start + partitions.PARTITION_PERIODS['week']})"))
+
+    def test_no_partitions_when_already_ahead(self):
+        now = datetime.datetime(2026, 10, 14, tzinfo=datetime.timezone.utc).timestamp()
+        last_bound = partitions.get_partition_start(now, 'day') + 8 * partitions.PARTITION_PERIODS['day']
+        self.assertEqual(partitions.get_partitions_ahead(last_bound, now, 'day', 7), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
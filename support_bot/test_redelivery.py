@@ -0,0 +1,58 @@
+"""
+Проверка отбрасывания повторной доставки после перезапуска при отложенной записи.
+Запуск: cd support_bot && python -m unittest test_redelivery
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+# Настройки читаются при импорте модулей бота, поэтому задаются до него
+_temp_dir = tempfile.TemporaryDirectory()
+os.environ.update(DB_BACKEND='sqlite', DB_SQLITE_PATH=os.path.join(_temp_dir.name, 'redelivery.db'),
+                  WRITE_BEHIND_ENABLED='true')
+os.environ.setdefault('ADMIN_CHAT_ID', '-1000000000001')
+os.environ.setdefault('BOT_TOKEN', '0:test')
+
+from benchmark import Context, FakeBot, UpdateFactory  # noqa: E402
+import db_connector  # noqa: E402
+import run  # noqa: E402
+from db_init import create_tables_with_indexes  # noqa: E402
+from settings import ADMIN_CHAT_ID, BAN_MESSAGE  # noqa: E402
+from telegram.ext import ApplicationHandlerStop  # noqa: E402
+
+
+class RedeliveryAfterRestartTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        assert create_tables_with_indexes()
+        asyncio.run(run.load_banned_users())
+
+    async def _deliver(self, update, context):
+        try:
+            await run.deduplicator.drop_duplicates(update, context)
+        except ApplicationHandlerStop:
+            return
+        await run.forward_message_to_admin_group(update, context)
+
+    def test_flushed_message_is_not_forwarded_again(self):
+        bot = FakeBot()
+        context = Context(bot)
+        update = UpdateFactory(bot, ADMIN_CHAT_ID, BAN_MESSAGE).text(10 ** 6)
+
+        asyncio.run(self._deliver(update, context))
+        self.assertEqual(bot.calls['forward_message'], 1)
+
+        # Перезапуск: строка уже в БД, буфер и кэш повторных доставок пусты
+        db_connector.message_buffer.flush()
+        self.assertEqual(len(db_connector.message_buffer), 0)
+        run.deduplicator._seen.clear()
+
+        asyncio.run(self._deliver(update, context))
+        self.assertEqual(bot.calls['forward_message'], 1)
+        self.assertEqual(db_connector.Messages.select().where(db_connector.Messages.user_id == 10 ** 6).count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри чата.
+Обновления разных чатов обрабатываются одновременно, а обновления одного чата
+и ответы админов одному пользователю выполняются строго по очереди.
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import telegram
+from telegram.ext import BaseUpdateProcessor
+
+from forward_map import forward_cache
+from settings import ADMIN_CHAT_ID
+
+logger = logging.getLogger(__name__)
+
+
+def get_ordering_key(update, use_cache=True):
+    """Возвращает ключ, внутри которого обновления обрабатываются по порядку.
+    С use_cache=False ключ зависит только от самого обновления и одинаков на всех репликах"""
+    if not isinstance(update, telegram.Update) or update.effective_chat is None:
+        return None
+
+    chat_id = update.effective_chat.id
+    message = update.effective_message
+    if chat_id != ADMIN_CHAT_ID or message is None or message.reply_to_message is None:
+        return chat_id
+
+    # Ответы админов упорядочиваем по пользователю, которому они адресованы
+    forward_origin = message.reply_to_message.forward_origin
+    if forward_origin is not None and forward_origin.type == telegram.constants.MessageOriginType.USER:
+        return forward_origin.sender_user.id
+    if not use_cache:
+        return chat_id
+    target = forward_cache.get(message.reply_to_message.message_id)
+    if target is not None:
+        return target.user_id
+    return chat_id
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает до max_active обновлений одновременно, сохраняя порядок внутри чата"""
+
+    def __init__(self, max_active, max_pending):
+        # Базовый семафор ограничивает число ожидающих обновлений, а собственный —
+        # число выполняемых: ожидание очереди чата не занимает слот выполнения
+        super().__init__(max(max_pending, max_active))
+        self._active_limit = max_active
+        self._active = asyncio.BoundedSemaphore(max_active)
+        self._chat_locks = {}
+        # Время завершения обработки последнего обновления, для проверки готовности
+        self.last_processed_at = None
+
+    @asynccontextmanager
+    async def ordered(self, key):
+        """Занимает очередь ключа key и слот выполнения, как при обработке обновления"""
+        if key is None:
+            async with self._active:
+                yield
+            return
+
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._active:
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        async with self.ordered(get_ordering_key(update)):
+            await coroutine
+        self.last_processed_at = time.time()
+
+    async def initialize(self):
+        logger.info(f"Параллельная обработка обновлений: до {self._active_limit} одновременно")
+
+    async def shutdown(self):
+        pass
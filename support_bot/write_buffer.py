@@ -0,0 +1,121 @@
+"""
+Отложенная пакетная запись строк в БД (write-behind).
+Строки копятся в памяти и записываются одним многострочным INSERT
+каждые max_rows строк или max_delay секунд. Пока строка не записана,
+она доступна для чтения и изменения прямо в буфере.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBufferFull(Exception):
+    """Буфер переполнен, а запись в БД не удается"""
+
+
+class WriteBehindBuffer:
+    """Буфер строк с периодическим сбросом через flush_func(rows)"""
+
+    def __init__(self, flush_func, max_rows, max_delay, max_pending=10000):
+        self._flush_func = flush_func
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._max_pending = max_pending
+        self._pending = []
+        self._flushing = []
+        # _lock защищает списки строк, _flush_lock — запись пакета в БД
+        self._lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновый сброс буфера по времени"""
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Останавливает фоновый сброс и синхронно записывает остаток буфера"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self._max_delay):
+            self.flush()
+
+    def add(self, row, unless=None):
+        """Добавляет строку; с условием unless не добавляет ее, если подходящая строка уже ждет записи.
+        Возвращает, добавлена ли строка"""
+        if len(self) >= self._max_pending:
+            # Пока БД недоступна, буфер не растет без ограничений: вызывающий сам пробует
+            # записать накопленное и получает ошибку, если запись не удалась
+            self.flush()
+            if len(self) >= self._max_pending:
+                raise WriteBufferFull(f"Буфер отложенной записи переполнен ({self._max_pending} строк)")
+        with self._lock:
+            # Проверка и добавление под одной блокировкой: повтор не проскочит между ними,
+            # а строки записываемого сейчас пакета тоже учитываются
+            if unless is not None and any(unless(pending) for pending in self._flushing + self._pending):
+                return False
+            self._pending.append(row)
+            full = len(self._pending) >= self._max_rows
+        if full:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Записывает накопленные строки одним пакетом"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, []
+            try:
+                self._flush_func(self._flushing)
+                return len(self._flushing)
+            except Exception as e:
+                logger.error(f"Ошибка при пакетной записи {len(self._flushing)} строк, повтор позже: {e}")
+                with self._lock:
+                    self._pending = self._flushing + self._pending
+                return 0
+            finally:
+                with self._lock:
+                    self._flushing = []
+
+    @contextmanager
+    def hold(self):
+        """Не дает начать запись пакета, пока изменяются строки буфера и БД"""
+        with self._flush_lock:
+            yield
+
+    def find_last(self, predicate):
+        """Возвращает последнюю еще не записанную строку, подходящую под условие"""
+        with self._lock:
+            for row in reversed(self._flushing + self._pending):
+                if predicate(row):
+                    return row
+        return None
+
+    def count(self, predicate):
+        with self._lock:
+            return sum(1 for row in self._flushing + self._pending if predicate(row))
+
+    def update(self, predicate, **changes):
+        """Изменяет еще не записанные строки; вызывается внутри hold()"""
+        with self._lock:
+            for row in self._pending:
+                if predicate(row):
+                    row.update(changes)
+
+    def remove(self, predicate):
+        """Удаляет еще не записанные строки; вызывается внутри hold()"""
+        with self._lock:
+            self._pending = [row for row in self._pending if not predicate(row)]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending) + len(self._flushing)